@@ -1,44 +1,76 @@
 import os
 
-import requests
-import aiohttp
-import asyncio
+import hashlib
 import json
-import ast
-from operator import itemgetter
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from datetime import datetime
+from flask import Flask, Response, abort, make_response, render_template, request, flash, redirect, session, g, jsonify, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+from cache import cache_stats, result_store
+import metrics
+from current_user import CurrentUser, forget_user
 from forms import UserAddForm, LoginForm, UserEditForm
-from models import db, connect_db, User, Movie, Subscription, User_Likes_Movie, Service
+from http_cache import cache_policy, static_url, http_date, is_not_modified, ONE_YEAR, STATIC_MAX_AGE, DEFAULT_POLICY
+from models import db, connect_db, bcrypt, read_session, close_replica_session, User, Movie, User_Likes_Movie, User_Available_Movie, Service
+from search_index import local_search
+from tmdb import client as tmdb_client
+from typeahead import suggestions
+from watchlist import add_to_watchlist, bump_watchlist_version, refresh_availability, storable
 
 
 CURR_USER_KEY = "curr_user"
-HEADERS = {
-                "accept": "application/json",
-                "Authorization": os.environ.get('TMDB_API_KEY')
-            }
-SUBSCRIPTIONS = ['Amazon Prime Video', 'Netflix', 'Disney Plus', 'HBO Max', 'Hulu', 'Peacock', 'Paramount Plus', 'Starz', 'Showtime', 'Apple TV Plus']
+WATCHLIST_PAGE_SIZE = 24
+MAX_BULK_IDS = 100
 
-def create_app(database_name, testing=False):
+def create_app(database_name, testing=False, bcrypt_rounds=None, production=None):
+    """Build the app and connect it to the database.
+
+    production (or APP_PROFILE=production) leaves out the debug toolbar and
+    turns on the connection pool settings. DATABASE_REPLICA_URL adds a read
+    replica that read-only views like /watchlist query through read_session().
+    """
 
     app = Flask(__name__)
+    if production is None:
+        production = os.environ.get('APP_PROFILE') == 'production'
 
     # Get DB_URI from environ variable (useful for production/testing) or,
     # if not set there, use development local db.
     app.config['SQLALCHEMY_DATABASE_URI'] = (
         os.environ.get('DATABASE_URL', f'postgresql:///{database_name}'))
-    
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ.get('DATABASE_REPLICA_URL')}
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres'):
+        # Per worker: pool_size + max_overflow connections at most, so
+        # workers * that has to stay under Postgres' max_connections
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        }
 
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_ECHO'] = False
     app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-    toolbar = DebugToolbarExtension(app)
+    # bcrypt work factor, each +1 doubles the time per hash. Existing hashes
+    # are upgraded (or downgraded) on the next login.
+    app.config['BCRYPT_LOG_ROUNDS'] = bcrypt_rounds or int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    bcrypt.init_app(app)
+    # Render search results straight away and stream the providers in after
+    app.config['STREAM_SEARCH'] = os.environ.get('STREAM_SEARCH', '1') == '1'
+    if not production:
+        toolbar = DebugToolbarExtension(app)
 
-    """ app.app_context().push()
-    connect_db(app) """
+    connect_db(app)
+    metrics.init_app(app)
+
+    @app.teardown_appcontext
+    def close_read_session(exc):
+        close_replica_session()
 
 
     ##############################################################################
@@ -50,7 +82,8 @@ def create_app(database_name, testing=False):
         """If we're logged in, add curr user to Flask global."""
 
         if CURR_USER_KEY in session:
-            g.user = User.query.get(session[CURR_USER_KEY])
+            # Doesn't hit the database until a view needs more than the basics
+            g.user = CurrentUser(session[CURR_USER_KEY])
 
         else:
             g.user = None
@@ -150,14 +183,17 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
         
-        form = UserEditForm(username=g.user.username, email=g.user.email, image_url=g.user.image_url, netflix = g.user.netflix, prime_video = g.user.prime_video, disney_plus = g.user.disney_plus, hbo_max = g.user.hbo_max, hulu = g.user.hulu, peacock = g.user.peacock, paramount_plus = g.user.paramount_plus, starz = g.user.starz, showtime = g.user.showtime, apple_tv = g.user.apple_tv)
+        # The row itself, the cached username can be out of date after a rename
+        user = g.user.load()
+        if user is None:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        form = UserEditForm(username=user.username, email=user.email, image_url=user.image_url, netflix = user.netflix, prime_video = user.prime_video, disney_plus = user.disney_plus, hbo_max = user.hbo_max, hulu = user.hulu, peacock = user.peacock, paramount_plus = user.paramount_plus, starz = user.starz, showtime = user.showtime, apple_tv = user.apple_tv)
 
 
         if form.validate_on_submit():
-            user = User.authenticate(g.user.username,
-                                     form.password.data)
-            
-            if user:
+            if user.verify_password(form.password.data):
                 user.username = form.username.data
                 user.email = form.email.data
                 user.image_url = form.image_url.data
@@ -171,8 +207,13 @@ def create_app(database_name, testing=False):
                 user.starz = form.starz.data
                 user.showtime = form.showtime.data
                 user.apple_tv = form.apple_tv.data
+                user.update_subscription_mask()
                 db.session.add(user)
+                db.session.flush()
+                refresh_availability(user.id)
+                bump_watchlist_version(User.id == user.id)
                 db.session.commit()
+                forget_user(user.id)
                 flash('Changes updated', "info")
                 return redirect('/')
             
@@ -190,8 +231,9 @@ def create_app(database_name, testing=False):
 
         do_logout()
 
-        db.session.delete(g.user)
+        db.session.delete(g.user.load())
         db.session.commit()
+        forget_user(g.user.id)
 
         return redirect("/signup")
 
@@ -206,53 +248,65 @@ def create_app(database_name, testing=False):
 
         """Make sure we query only if nothing is in our session just to be sure"""
         search = request.args.get('q')
+        page = max(request.args.get('page', 1, type=int), 1)
+
+        # Try our own movies table first, and only go to TMDB if it can't answer.
+        # ?source=tmdb skips it, the local page links there for the full results.
+        from_tmdb = page > 1 or request.args.get('source') == 'tmdb'
+        updated_movies_list = None if from_tmdb else local_search(search)
+        local = updated_movies_list is not None
+        total_pages = 1
+        stream = app.config['STREAM_SEARCH'] and updated_movies_list is None
+
+        # Only the TMDB calls run on the per-worker client loop, the rest of the
+        # view stays on this thread. The next pages get prefetched in the background.
+        if stream:
+            # Providers get filled in by the page from /search/providers
+            updated_movies_list, total_pages = tmdb_client.run(tmdb_client.search_results(search, page, providers=False))
+        elif updated_movies_list is None:
+            updated_movies_list, total_pages = tmdb_client.run(tmdb_client.search_results(search, page))
+
+        # Old sessions carried the whole results list, drop it
+        if 'api_data' in session:
+            session.pop('api_data')
+        # The provider stream picks the results up by token, or from q and page
+        # when it lands on a worker that doesn't have them
+        token = result_store.put(updated_movies_list) if stream else None
+
+        return render_template('movie_search.html', results=updated_movies_list, token=token, stream=stream,
+                               search=search, page=page, total_pages=total_pages, local=local)
+
+    @app.route('/search/suggest')
+    @cache_policy('public, max-age=60')
+    def search_suggest():
+        """As-you-type title suggestions, from memory only, never TMDB."""
+        if not suggestions.loaded:
+            suggestions.load()
+        response = jsonify(suggestions.suggest(request.args.get('q', '')))
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app.route('/search/providers')
+    def search_providers():
+        """Server-sent events with the providers for each search result, sent as each lookup finishes."""
+        movies = result_store.get(request.args.get('token'))
+        if movies is None and request.args.get('q'):
+            page = max(request.args.get('page', 1, type=int), 1)
+            movies, _ = tmdb_client.run(tmdb_client.search_page(request.args.get('q'), page))
+
+        def events():
+            for movie in tmdb_client.iter_providers(movies or []):
+                data = {
+                    'id': movie['id'],
+                    'flatrate': movie.get('flatrate'),
+                    'unknown': movie.get('providers_unknown', False),
+                }
+                yield f"data: {json.dumps(data)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
 
-        url = f"https://api.themoviedb.org/3/search/movie?query={search}&include_adult=false&language=en-US&page=1"
-        search_response = requests.get(url, headers=HEADERS)
-
-        """This section is making it easier for jinja to use.
-        Jsons the values, maps the results then sorts them by popularity so the most popular movie in the search is displayed first.
-        """
-        movie_values = search_response.json().get('results')
-        movie_newlist = sorted(movie_values, key=itemgetter('popularity'), reverse=True)
-        """ for result in results:
-            print(result.get('id')) """
-
-        updated_movies_list = asyncio.run(main_get(movie_newlist))
-        """Use session here so we don't keep making requests to the api"""
-        session['api_data'] = updated_movies_list
-        session.modified = True
-
-        return render_template('movie_search.html', results=session['api_data'])
-
-    async def get_providers(session, movie):
-        """Async function so we can loop through each movie and call the providers api"""
-        movie_id = movie['id']
-        url = f"https://api.themoviedb.org/3/movie/{movie_id}/watch/providers"
-
-        async with session.get(url, headers=HEADERS) as response:
-            if response.status == 200:
-                result = await response.json()
-                another = result.get('results')
-                us = another.get('US')
-                if us == None:
-                    movie['flatrate'] = None
-                    return movie
-                flatrate = us.get('flatrate')
-                movie['flatrate'] = flatrate
-                return movie
-            else:
-                print(f"Failed to get data for movie ID {movie_id}: {response.status}")
-                movie['flatrate'] = flatrate
-                return movie
-        
-    async def main_get(movies):
-        """Main async function for calling the providers api"""
-        async with aiohttp.ClientSession() as session:
-            tasks = [get_providers(session, movie) for movie in movies]
-            updated_movies = await asyncio.gather(*tasks)
-            return updated_movies
-    
     @app.route('/movies/like', methods=['POST'])
     def watchlist_button():
         if not g.user:
@@ -260,42 +314,47 @@ def create_app(database_name, testing=False):
             return redirect("/")
         
 
-        # This is called when a user clicks to add a movie to watchlist
-        movie_info_str = request.form.get('add_watchlist') # gets the selected movie
-        if movie_info_str:
-            try:
-                dict_obj = ast.literal_eval(movie_info_str) # converts to dictionary
-                new_id = int(dict_obj.get('id'))
-                movie = Movie.query.filter_by(movie_id=new_id).first()
-                if not movie:
-                    movie = Movie(movie_id=int(dict_obj.get('id')), name=dict_obj.get('title'), description=dict_obj.get('overview'), image_url=dict_obj.get('poster_path'), year=dict_obj.get('release_date'))
-                    db.session.add(movie)
-                    db.session.commit()
-                likes = User_Likes_Movie.query.filter_by(user_liking_id=g.user.id, liked_movie_id=movie.id).first()
-                if not likes:
-                    likes = User_Likes_Movie(user_liking_id=g.user.id, liked_movie_id=movie.id)
-                    db.session.add(likes)
-                    db.session.commit()
-                services = []
-                flatrate = dict_obj.get('flatrate')
-
-                for service in flatrate:
-                    if service.get('provider_name') in SUBSCRIPTIONS:
-                        services.append(service.get('provider_name'))
-
-                for service in services:
-                    db_service = Service.query.filter_by(name=service).first()
-                    subscription = Subscription.query.filter_by(movie_id=movie.id, service_id=db_service.id).first()
-                    if not subscription:
-                        subscription = Subscription(movie_id=movie.id, service_id=db_service.id)
-                        db.session.add(subscription)
-                        db.session.commit()
-                title = dict_obj.get('title')
-                results = {'message': f'Added {title} to watchlist!'}
-            except ValueError as e:
-                print("Error converting string to dictionary", e)
+        # This is called when a user clicks to add a movie to watchlist.
+        # The page only sends the TMDB id, the details and providers come from our cache.
+        movie_id = request.form.get('add_watchlist', type=int) # gets the selected movie
+        if not movie_id:
+            return jsonify({'message': 'No movie selected'}), 400
+
+        movies = storable(tmdb_client.run(tmdb_client.resolve_movies([movie_id])))
+        if not movies:
+            return jsonify({'message': 'Could not find that movie'}), 404
+
+        title = movies[0]['title']
+        if not add_to_watchlist(g.user.id, movies):
+            return jsonify({'message': f'{title} is already on your watchlist'})
+        results = {'message': f'Added {title} to watchlist!'}
         return jsonify(results)
-    
+
+    @app.route('/movies/like/bulk', methods=['POST'])
+    def watchlist_bulk():
+        """Add many movies at once, for "add all" and imports. Takes JSON {"ids": [TMDB movie ids]}, up to MAX_BULK_IDS."""
+        if not g.user:
+            return jsonify({'message': 'Access unauthorized.'}), 401
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify({'message': 'Send a JSON object like {"ids": [...]}'}), 400
+        try:
+            ids = list(dict.fromkeys(int(movie_id) for movie_id in body.get('ids') or []))
+        except (TypeError, ValueError):
+            return jsonify({'message': 'ids must be TMDB movie ids'}), 400
+        if not ids:
+            return jsonify({'message': 'No movies selected'}), 400
+        # Every id is up to two TMDB calls through this worker's rate limiter
+        if len(ids) > MAX_BULK_IDS:
+            return jsonify({'message': f'At most {MAX_BULK_IDS} movies at a time'}), 413
+
+        movies = storable(tmdb_client.run(tmdb_client.resolve_movies(ids)))
+        if not movies:
+            return jsonify({'message': 'Could not find those movies', 'added': 0}), 404
+        added = add_to_watchlist(g.user.id, movies)
+        return jsonify({'message': f'Added {len(added)} movies to watchlist!', 'added': len(added)})
+
     @app.route('/watchlist')
     def watchlist():
         """Displays user's list of movies to watch"""
@@ -303,47 +362,103 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
         
-        user_likes = User_Likes_Movie.query.filter_by(user_liking_id=g.user.id).all()
-        movie_dict = []
-
-        for like in user_likes:
-            movie = Movie.query.get(like.liked_movie_id)
-            subscription_list = []
-            subscription_query = Subscription.query.filter_by(movie_id=movie.id).all()
-            for subscription in subscription_query:
-                service = Service.query.get(subscription.service_id)
-                if user_subscription_switch_case(service):
-                    subscription_list.append(service.image_url)
-            dict_subscriptions = {movie.id: [movie, subscription_list]}
-            movie_dict.append(dict_subscriptions)
-
-        return render_template('watchlist.html', movie_dict=movie_dict)
-
-    def user_subscription_switch_case(service):
-        if g.user.netflix and service.id == 1:
-            return True
-        elif g.user.prime_video and service.id == 2:
-            return True
-        elif g.user.disney_plus and service.id == 3:
-            return True
-        elif g.user.hbo_max and service.id == 4:
-            return True
-        elif g.user.hulu and service.id == 5:
-            return True
-        elif g.user.peacock and service.id == 6:
-            return True
-        elif g.user.paramount_plus and service.id == 7:
-            return True
-        elif g.user.starz and service.id == 8:
-            return True
-        elif g.user.showtime and service.id == 9:
-            return True
-        elif g.user.apple_tv  and service.id == 9:
-            return True
-        else:
-            return False
-
+        def build(version):
+            available = bool(request.args.get('available', 0, type=int))
+            movies, next_cursor = watchlist_page(request.args.get('cursor'), available=available, since=version)
+            movie_dict = [{movie.id: [movie, services]} for movie, services in movies]
+            return render_template('watchlist.html', movie_dict=movie_dict, next_cursor=next_cursor, available=available)
+
+        return watchlist_response(build)
+
+    @app.route('/api/watchlist')
+    def watchlist_api():
+        """JSON pages of the user's watchlist, newest first. Pass next_cursor back as ?cursor= for the next page,
+        and ?available=1 for just the movies on the user's services."""
+        if not g.user:
+            return jsonify({'message': 'Access unauthorized.'}), 401
+
+        def build(version):
+            movies, next_cursor = watchlist_page(request.args.get('cursor'), request.args.get('limit', type=int),
+                                                 bool(request.args.get('available', 0, type=int)), since=version)
+            results = [{
+                'id': movie.id,
+                'name': movie.name,
+                'image_url': movie.image_url,
+                'services': services,
+            } for movie, services in movies]
+            return jsonify({'results': results, 'next_cursor': next_cursor})
+
+        return watchlist_response(build)
+
+    def watchlist_response(build):
+        """Answer with a 304 if the client's copy of this watchlist page is
+        still current, which only costs a primary key lookup. Otherwise build(version) it.
+
+        The version is read from the users row rather than a per-worker cache,
+        so a change made by another worker or the refresher shows up at once.
+        """
+        version, mask = (db.session.query(User.watchlist_version, User.subscription_mask)
+                         .filter(User.id == g.user.id).one())
+        key = f"{g.user.id}:{version}:{mask}:{request.full_path}"
+        etag = hashlib.md5(key.encode()).hexdigest()
 
+        if is_not_modified(etag, version):
+            response = Response(status=304)
+        else:
+            response = make_response(build(version))
+        response.set_etag(etag)
+        response.last_modified = http_date(int(version))
+        return response
+
+    def watchlist_page(cursor=None, limit=None, available=False, since=None):
+        """One page of the current user's watchlist as [(movie, service images)], and the cursor for the next page.
+
+        Uses keyset pagination on (added_at, movie id) so a deep page costs the
+        same as the first one. One query for the liked movies and one for the
+        services they're on, straight out of the precomputed user_available_movies.
+        available only keeps the movies that are on one of the user's services.
+
+        since is the watchlist version the page goes out under. Right after a
+        change the replica might not have it yet, and a page built from it would
+        keep getting 304s under the new ETag, so that reads from the primary.
+        """
+        session = read_session(since)
+        limit = max(1, min(limit or WATCHLIST_PAGE_SIZE, 100))
+        query = (session.query(Movie, User_Likes_Movie.added_at)
+                 .join(User_Likes_Movie, User_Likes_Movie.liked_movie_id == Movie.id)
+                 .filter(User_Likes_Movie.user_liking_id == g.user.id)
+                 .order_by(User_Likes_Movie.added_at.desc(), User_Likes_Movie.liked_movie_id.desc()))
+        if available:
+            query = query.filter(db.exists().where(User_Available_Movie.user_id == g.user.id,
+                                                   User_Available_Movie.movie_id == User_Likes_Movie.liked_movie_id))
+
+        if cursor:
+            try:
+                added_at, movie_id = cursor.rsplit('_', 1)
+                position = (datetime.fromisoformat(added_at), int(movie_id))
+            except ValueError:
+                abort(400)
+            query = query.filter(db.tuple_(User_Likes_Movie.added_at, User_Likes_Movie.liked_movie_id) < position)
+
+        rows = query.limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_movie, last_added = rows[-1]
+            next_cursor = f"{last_added.isoformat()}_{last_movie.id}"
+
+        services = {movie.id: [] for movie, added_at in rows}
+        if services:
+            available_services = (session.query(User_Available_Movie.movie_id, Service.image_url)
+                                  .join(Service, Service.id == User_Available_Movie.service_id)
+                                  .filter(User_Available_Movie.user_id == g.user.id,
+                                          User_Available_Movie.movie_id.in_(services))
+                                  .order_by(Service.id))
+            for movie_id, image_url in available_services:
+                services[movie_id].append(image_url)
+
+        movies = [(movie, services[movie.id]) for movie, added_at in rows]
+        return movies, next_cursor
 
     @app.route('/movies/<int:id>/remove_watchlist', methods=['POST'])
     def remove_watchlist(id):
@@ -357,6 +472,9 @@ def create_app(database_name, testing=False):
             return redirect("/")
 
         db.session.delete(likes)
+        db.session.flush()
+        refresh_availability(g.user.id, [id])
+        bump_watchlist_version(User.id == g.user.id)
         db.session.commit()
         flash("Removed from watchlist", "info")
         return redirect(request.referrer)
@@ -366,31 +484,55 @@ def create_app(database_name, testing=False):
 
 
     @app.route('/')
+    @cache_policy(anonymous='public, max-age=300')
     def homepage():
         """Show homepage"""
         return render_template('home.html')
     
     @app.route('/about')
+    @cache_policy(anonymous='public, max-age=300')
     def about():
         """The about page"""
         return render_template('about.html')
+
+    @app.route('/cache/stats')
+    def cache_stats_view():
+        """Hit/miss counters for the TMDB caches"""
+        return jsonify(cache_stats())
         
     @app.errorhandler(404)
     def page_not_found(e):
         return render_template('404.html'), 404
 
+    @app.template_global('static_url')
+    def static_url_global(filename):
+        return static_url(app, filename)
+
     @app.after_request
     def add_header(req):
-        """Add non-caching headers on every request."""
+        """Cache-Control for every response, from the view's cache_policy.
 
-        req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        req.headers["Pragma"] = "no-cache"
-        req.headers["Expires"] = "0"
-        req.headers['Cache-Control'] = 'public, max-age=0'
+        Fingerprinted static files are cached for a year. Pages default to
+        private, no-cache, and the anonymous policy is only used if nobody is
+        logged in and the session wasn't touched (e.g. by a flashed message).
+        """
+        if request.endpoint == 'static':
+            max_age = ONE_YEAR if request.args.get('v') else STATIC_MAX_AGE
+            req.headers['Cache-Control'] = f'public, max-age={max_age}'
+            if request.args.get('v'):
+                req.headers['Cache-Control'] += ', immutable'
+            return req
+
+        view = app.view_functions.get(request.endpoint)
+        cache_control = getattr(view, 'cache_control', DEFAULT_POLICY)
+        anonymous = getattr(view, 'anonymous_cache_control', None)
+        if anonymous and not g.get('user') and not session.modified:
+            cache_control = anonymous
+        req.headers['Cache-Control'] = cache_control
+        req.vary.add('Cookie')
         return req
     return app
 
 if __name__=='__main__':
     app = create_app('stream_tracker_db')
-    #connect_db(app)
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""Local stand-in for the TMDB API, so benchmarks never hit the real thing.
+
+Serves /3/search/movie, /3/movie/{id} and /3/movie/{id}/watch/providers with
+made up but repeatable data (the same query or id always gives the same
+answer). Latency and error rate are configurable:
+
+    python -m bench.fake_tmdb --port 8765 --latency-ms 80 --jitter-ms 40 --error-rate 0.02
+
+then point the app at it with TMDB_BASE_URL=http://localhost:8765/3
+"""
+import argparse
+import asyncio
+import random
+import zlib
+
+from aiohttp import web
+
+from models import SERVICE_FIELDS
+
+WORDS = ['star', 'night', 'dark', 'love', 'war', 'last', 'city', 'house', 'dead', 'summer',
+         'girl', 'man', 'king', 'blood', 'secret', 'story', 'lost', 'world', 'river', 'game']
+PROVIDERS = [name for field, name in SERVICE_FIELDS]
+
+
+def seeded(value):
+    return random.Random(zlib.crc32(str(value).encode()))
+
+
+def fake_movie(movie_id):
+    rng = seeded(movie_id)
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+    return {
+        'id': movie_id,
+        'title': title,
+        'overview': f"A movie about {' and '.join(rng.sample(WORDS, 3))}.",
+        'poster_path': f"/poster{movie_id}.jpg",
+        'release_date': f"{rng.randint(1960, 2024)}-01-01",
+        'popularity': round(rng.uniform(1, 500), 3),
+    }
+
+
+def fake_providers(movie_id):
+    rng = seeded(f"providers{movie_id}")
+    if rng.random() < 0.2:
+        return {'id': movie_id, 'results': {}}
+    flatrate = [{'provider_name': name, 'logo_path': f"/{name.lower().replace(' ', '_')}.jpg"}
+                for name in rng.sample(PROVIDERS, rng.randint(1, 3))]
+    return {'id': movie_id, 'results': {'US': {'flatrate': flatrate}}}
+
+
+def make_app(latency_ms=50, jitter_ms=0, error_rate=0.0, results_per_page=20, total_pages=5):
+    rng = random.Random()
+
+    async def delay():
+        """Sleep like a real API would, and sometimes fail like one."""
+        await asyncio.sleep(max(0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000)
+        if rng.random() < error_rate:
+            raise web.HTTPTooManyRequests() if rng.random() < 0.5 else web.HTTPServiceUnavailable()
+
+    async def search(request):
+        await delay()
+        query = request.query.get('query', '')
+        page = int(request.query.get('page', 1))
+        base = zlib.crc32(query.lower().encode()) % 100000 * 100
+        results = [fake_movie(base + (page - 1) * results_per_page + i) for i in range(results_per_page)]
+        return web.json_response({'page': page, 'results': results, 'total_pages': total_pages,
+                                  'total_results': total_pages * results_per_page})
+
+    async def movie(request):
+        await delay()
+        return web.json_response(fake_movie(int(request.match_info['id'])))
+
+    async def providers(request):
+        await delay()
+        return web.json_response(fake_providers(int(request.match_info['id'])))
+
+    app = web.Application()
+    app.router.add_get('/3/search/movie', search)
+    app.router.add_get('/3/movie/{id}', movie)
+    app.router.add_get('/3/movie/{id}/watch/providers', providers)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency_ms, args.jitter_ms, args.error_rate), port=args.port)
@@ -0,0 +1,173 @@
+"""Repeatable load scenarios for /search, /watchlist and /movies/like.
+
+By default everything runs in this process: a fake TMDB server on a
+background thread and the app through Flask's test client, against whatever
+DATABASE_URL points at (seed it with bench.seed_bench first). Pass --url to
+load test a running server instead; it has to be started with TMDB_BASE_URL
+pointing at bench.fake_tmdb.
+
+    python -m bench.run --scenario all --concurrency 8 --requests 500
+    python -m bench.run --scenario search --url http://localhost:5000
+
+Prints throughput and latency percentiles for each scenario.
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fake_tmdb import WORDS
+
+FAKE_TMDB_PORT = 8765
+SCENARIOS = ['search', 'watchlist', 'like']
+
+
+def start_fake_tmdb(latency_ms, error_rate, port=FAKE_TMDB_PORT):
+    """Run bench.fake_tmdb on a background thread."""
+    import asyncio
+    from aiohttp import web
+    from bench.fake_tmdb import make_app
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(latency_ms, latency_ms / 2, error_rate))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, 'localhost', port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+class InProcessClient:
+    """The app's test client, logged in as user_id."""
+
+    def __init__(self, app, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['curr_user'] = user_id
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_data()
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient:
+    """requests against a running server, logged in through /login."""
+
+    def __init__(self, url, username, password='password'):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        page = self.session.get(f"{self.url}/login").text
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page)
+        self.session.post(f"{self.url}/login", data={
+            'username': username, 'password': password, 'csrf_token': token.group(1) if token else ''})
+
+    def get(self, path):
+        response = self.session.get(f"{self.url}{path}")
+        return response.status_code, response.content
+
+    def post(self, path, data):
+        response = self.session.post(f"{self.url}{path}", data=data)
+        return response.status_code, response.content
+
+
+def search(client, rng):
+    query = ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+    status, body = client.get(f"/search?q={query}")
+    # With streaming search the providers come from a second request
+    token = re.search(rb"token=([\w-]+)'", body)
+    if status == 200 and token:
+        status, body = client.get(f"/search/providers?token={token.group(1).decode()}")
+    return status
+
+
+def watchlist(client, rng):
+    status, body = client.get("/watchlist")
+    return status
+
+
+def like(client, rng):
+    status, body = client.post("/movies/like", {'add_watchlist': rng.randint(1, 10000000)})
+    return status
+
+
+def run_scenario(name, make_client, users, concurrency, requests, seed):
+    scenario = globals()[name]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(index):
+        nonlocal errors
+        if not hasattr(local, 'client'):
+            local.client = make_client(random.Random(seed + index).choice(users))
+            local.rng = random.Random(seed + index)
+        start = time.perf_counter()
+        status = scenario(local.client, local.rng)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    total = time.perf_counter() - start
+    report(name, latencies, errors, total)
+
+
+def percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name, latencies, errors, total):
+    latencies = sorted(latencies)
+    print(f"{name:<10} {len(latencies)} requests in {total:.2f}s = {len(latencies) / total:.1f} req/s, "
+          f"{errors} errors | mean {statistics.mean(latencies) * 1000:.1f}ms "
+          f"p50 {percentile(latencies, 50) * 1000:.1f}ms p90 {percentile(latencies, 90) * 1000:.1f}ms "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS + ['all'], default='all')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--url', help='load test a running server instead of the in-process app')
+    parser.add_argument('--users', type=int, default=10, help='with --url, log in as bench1..benchN')
+    parser.add_argument('--tmdb-port', type=int, default=FAKE_TMDB_PORT)
+    parser.add_argument('--tmdb-latency-ms', type=float, default=50)
+    parser.add_argument('--tmdb-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    scenarios = SCENARIOS if args.scenario == 'all' else [args.scenario]
+
+    if args.url:
+        users = [f"bench{user_id}" for user_id in range(1, args.users + 1)]
+        make_client = lambda user: HTTPClient(args.url, user)
+    else:
+        os.environ['TMDB_BASE_URL'] = f"http://localhost:{args.tmdb_port}/3"
+        start_fake_tmdb(args.tmdb_latency_ms, args.tmdb_error_rate, args.tmdb_port)
+
+        from app import create_app
+        from models import User
+
+        app = create_app("stream_tracker_bench", production=True)
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.app_context():
+            users = [user_id for user_id, in User.query.with_entities(User.id).all()]
+        if not users:
+            raise SystemExit("No users, run python -m bench.seed_bench first")
+        make_client = lambda user: InProcessClient(app, user)
+
+    for name in scenarios:
+        run_scenario(name, make_client, users, args.concurrency, args.requests, args.seed)
@@ -0,0 +1,83 @@
+"""Fills a database with fake users that have big watchlists, for benchmarks.
+
+    DATABASE_URL=postgresql:///stream_tracker_bench python -m bench.seed_bench --users 200 --movies 20000 --likes 500
+
+Users are bench1, bench2... and all have the password "password". Uses bulk inserts, so even large
+data sets only take a few seconds.
+"""
+import argparse
+import random
+
+from faker import Faker
+
+from app import create_app
+from models import db, User, Movie, Service, Subscription, User_Likes_Movie, SERVICE_FIELDS, SERVICE_BITS, SERVICE_NAME_BITS
+from passwords import bcrypt
+from watchlist import refresh_availability
+
+
+def seed(users=100, movies=10000, likes=200, seed=1):
+    fake = Faker()
+    Faker.seed(seed)
+    rng = random.Random(seed)
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(Service), [
+        {'id': index + 1, 'name': name, 'image_url': f"https://image.tmdb.org/t/p/original/{field}.jpg",
+         'bit': SERVICE_NAME_BITS[name]}
+        for index, (field, name) in enumerate(SERVICE_FIELDS)
+    ])
+
+    db.session.execute(db.insert(Movie), [
+        {'id': movie_id, 'movie_id': 1000000 + movie_id, 'name': fake.catch_phrase(),
+         'description': fake.paragraph(), 'image_url': f"/poster{movie_id}.jpg",
+         'year': str(rng.randint(1960, 2024)), 'popularity': round(rng.uniform(1, 500), 3)}
+        for movie_id in range(1, movies + 1)
+    ])
+
+    db.session.execute(db.insert(Subscription), [
+        {'movie_id': movie_id, 'service_id': service_id}
+        for movie_id in range(1, movies + 1)
+        for service_id in rng.sample(range(1, len(SERVICE_FIELDS) + 1), rng.randint(0, 3))
+    ])
+
+    # Hashing once is plenty, every user gets the same password
+    password = bcrypt.generate_password_hash('password').decode('UTF-8')
+    user_rows = []
+    for user_id in range(1, users + 1):
+        flags = {field: rng.random() < 0.4 for field, name in SERVICE_FIELDS}
+        user_rows.append({
+            'id': user_id, 'username': f"bench{user_id}", 'email': f"bench{user_id}@example.com",
+            'password': password, 'subscription_mask': sum(SERVICE_BITS[field] for field, on in flags.items() if on),
+            **flags,
+        })
+    db.session.execute(db.insert(User), user_rows)
+
+    db.session.execute(db.insert(User_Likes_Movie), [
+        {'user_liking_id': user_id, 'liked_movie_id': movie_id,
+         'added_at': fake.date_time_between(start_date='-2y')}
+        for user_id in range(1, users + 1)
+        for movie_id in rng.sample(range(1, movies + 1), min(likes, movies))
+    ])
+    refresh_availability()
+    if db.engine.dialect.name == 'postgresql':
+        # The ids above were set by hand, move the sequences past them
+        for table in ['services', 'movies', 'users']:
+            db.session.execute(db.text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+    db.session.commit()
+    print(f"Seeded {users} users, {movies} movies, {likes} likes each")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=200, help='watchlist size per user')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    app = create_app("stream_tracker_bench", production=True)
+    with app.app_context():
+        seed(args.users, args.movies, args.likes, args.seed)
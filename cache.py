@@ -0,0 +1,245 @@
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """In-process cache. Every entry has its own expiry and the least recently
+    used entry is evicted once max_size is reached."""
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None if it's missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    """Shared backend so every gunicorn worker reuses the same entries.
+    Values have to be JSON serializable."""
+
+    def __init__(self, url, prefix='stream_tracker:'):
+        # redis is only needed when a shared cache is configured
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        return json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def add(self, key, ttl):
+        """Set key only if it isn't there yet. True if it was set."""
+        return bool(self.client.set(self.prefix + key, 1, nx=True, px=int(ttl * 1000)))
+
+
+class Cache:
+    """Named cache with a local TTLCache in front of an optional shared backend.
+    Keeps hit/miss counters so we can see how well it's doing."""
+
+    def __init__(self, name, max_size=1024, ttl=300, shared=None):
+        self.name = name
+        self.ttl = ttl
+        self.local = TTLCache(max_size=max_size, ttl=ttl)
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{self.name}:{key}"
+
+    def get(self, key, record=True):
+        """record=False leaves the value out of the hit/miss counts, for polling."""
+        key = self._key(key)
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                print(f"Shared cache get failed for {key}: {e}")
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+        if not record:
+            return value
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        key = self._key(key)
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl or self.ttl)
+            except Exception as e:
+                print(f"Shared cache set failed for {key}: {e}")
+
+    def delete(self, key):
+        key = self._key(key)
+        self.local.delete(key)
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception as e:
+                print(f"Shared cache delete failed for {key}: {e}")
+
+    def claim(self, key, ttl):
+        """Claim fetching key for this worker, so other workers wait for it to
+        land in the shared backend instead of fetching it too. True if the
+        claim is ours, which it always is without a shared backend."""
+        if self.shared is None:
+            return True
+        try:
+            return self.shared.add(f"flight:{self._key(key)}", ttl)
+        except Exception as e:
+            print(f"Shared cache claim failed for {key}: {e}")
+            return True
+
+    def release(self, key):
+        if self.shared is not None:
+            try:
+                self.shared.delete(f"flight:{self._key(key)}")
+            except Exception as e:
+                print(f"Shared cache release failed for {key}: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'size': len(self.local),
+        }
+
+
+class ResultStore:
+    """Server-side store for search results, so the provider stream can find
+    them by a short token. Per worker unless there's a shared backend.
+    Entries expire after ttl seconds and the oldest ones are dropped once the
+    stored JSON goes over max_bytes."""
+
+    def __init__(self, name, max_bytes=32 * 1024 * 1024, ttl=60 * 30, shared=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value):
+        """Store value and return the token for it."""
+        token = secrets.token_urlsafe(12)
+        size = len(json.dumps(value))
+        with self._lock:
+            self._data[token] = (time.monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                _, (_, old_size, _) = self._data.popitem(last=False)
+                self.bytes -= old_size
+        if self.shared is not None:
+            try:
+                self.shared.set(f"{self.name}:{token}", value, self.ttl)
+            except Exception as e:
+                print(f"Shared result store set failed: {e}")
+        return token
+
+    def get(self, token):
+        if not token:
+            return None
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is not None:
+                expires, size, value = entry
+                if expires >= time.monotonic():
+                    self._data.move_to_end(token)
+                    return value
+                del self._data[token]
+                self.bytes -= size
+        # Might have been stored by another worker
+        if self.shared is not None:
+            try:
+                return self.shared.get(f"{self.name}:{token}")
+            except Exception as e:
+                print(f"Shared result store get failed: {e}")
+        return None
+
+    def stats(self):
+        return {'size': len(self._data), 'bytes': self.bytes}
+
+
+def shared_backend():
+    """Use redis as the shared backend if CACHE_REDIS_URL is set, otherwise stay in-process."""
+    url = os.environ.get('CACHE_REDIS_URL')
+    if url:
+        return RedisBackend(url)
+    return None
+
+
+_shared = shared_backend()
+
+# Search results keyed by the query string, providers keyed by TMDB movie id.
+search_cache = Cache('search', max_size=512, ttl=60 * 10, shared=_shared)
+provider_cache = Cache('providers', max_size=4096, ttl=60 * 60 * 6, shared=_shared)
+# Movie details keyed by TMDB movie id, filled in from search results
+movie_cache = Cache('movies', max_size=8192, ttl=60 * 60 * 24, shared=_shared)
+
+# The few fields of the logged in user every page needs. Kept per worker and
+# short lived, profile edits and deletes drop the entry.
+user_cache = Cache('users', max_size=10000, ttl=60)
+
+CACHES = [search_cache, provider_cache, movie_cache, user_cache]
+
+# Search results for the session, looked up by the token kept in the cookie
+result_store = ResultStore('results', max_bytes=int(os.environ.get('RESULT_STORE_MAX_BYTES', 32 * 1024 * 1024)), shared=_shared)
+
+
+def cache_stats():
+    stats = {cache.name: cache.stats() for cache in CACHES}
+    stats[result_store.name] = result_store.stats()
+    return stats
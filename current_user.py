@@ -0,0 +1,44 @@
+from cache import user_cache
+from models import db, User
+
+# What the nav bar and the watchlist views need on every request
+CACHED_FIELDS = ('id', 'username', 'image_url', 'subscription_mask')
+
+
+class CurrentUser:
+    """Lazy stand-in for the logged in User that goes on g.user.
+
+    The fields in CACHED_FIELDS come from user_cache, so most requests never
+    touch the database for the user. Any other attribute (email, password,
+    the service booleans...) loads the row the first time it's asked for.
+    """
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self._row = None
+        self._fields = user_cache.get(user_id)
+
+    def load(self):
+        """The actual User row, or None if it's been deleted."""
+        if self._row is None:
+            self._row = db.session.get(User, self.id)
+            if self._row is not None:
+                self._fields = {field: getattr(self._row, field) for field in CACHED_FIELDS}
+                user_cache.set(self.id, self._fields)
+        return self._row
+
+    def __bool__(self):
+        return self._fields is not None or self.load() is not None
+
+    def __getattr__(self, name):
+        if name in CACHED_FIELDS:
+            if self._fields is None:
+                self.load()
+            if self._fields is not None:
+                return self._fields[name]
+        return getattr(self.load(), name)
+
+
+def forget_user(user_id):
+    """Drop the cached fields after the user changes or goes away."""
+    user_cache.delete(user_id)
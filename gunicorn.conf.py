@@ -0,0 +1,12 @@
+# gunicorn server:app
+#
+# The search and like views spend most of their time waiting on the worker's
+# TMDB client loop. gthread workers let one process have many of them in
+# flight at once, a sync worker would only ever serve one.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
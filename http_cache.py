@@ -0,0 +1,51 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from flask import request
+
+ONE_YEAR = 60 * 60 * 24 * 365
+STATIC_MAX_AGE = 60 * 60
+DEFAULT_POLICY = 'private, no-cache'
+
+
+def cache_policy(cache_control=DEFAULT_POLICY, anonymous=None):
+    """Set the Cache-Control for a view. anonymous is used instead when
+    nobody's logged in, since every page shows the user in the nav bar."""
+
+    def decorator(view):
+        view.cache_control = cache_control
+        view.anonymous_cache_control = anonymous
+        return view
+
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def file_fingerprint(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:10]
+
+
+def static_url(app, filename):
+    """/static url with a content hash, so the file can be cached for a year
+    and still change as soon as it's edited."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        return f"/static/{filename}?v={file_fingerprint(path)}"
+    except OSError:
+        return f"/static/{filename}"
+
+
+def http_date(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def is_not_modified(etag, last_modified=None):
+    """True if the client's copy (If-None-Match / If-Modified-Since) is still current."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since:
+        return request.if_modified_since >= http_date(int(last_modified))
+    return False
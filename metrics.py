@@ -0,0 +1,193 @@
+"""Request level instrumentation and a Prometheus style /metrics endpoint.
+
+Tracks latency per route, SQL queries per request, TMDB calls per endpoint
+and the cache/password pool stats. Set SLOW_REQUEST_MS to log any request
+slower than that with a breakdown of where the time went.
+"""
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import cache_stats
+from passwords import pool as password_pool
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    """Cumulative bucket histogram, one series per label tuple."""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with _lock:
+            counts, total = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.series[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for label_values, (counts, total) in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                running = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    running += count
+                    le = format_labels(self.labels + ('le',), label_values + (str(bound),))
+                    lines.append(f"{self.name}_bucket{le} {running}")
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {running}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for label_values, value in sorted(self.series.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+request_latency = Histogram('http_request_duration_seconds', 'Request latency by route', ('endpoint', 'method', 'status'))
+request_queries = Histogram('http_request_sql_queries', 'SQL queries per request', ('endpoint',), COUNT_BUCKETS)
+request_sql_time = Histogram('http_request_sql_seconds', 'Time spent in SQL per request', ('endpoint',))
+sql_queries = Counter('sql_queries_total', 'SQL queries run, in and out of requests', ())
+tmdb_latency = Histogram('tmdb_request_duration_seconds', 'TMDB call latency by endpoint', ('endpoint',))
+tmdb_responses = Counter('tmdb_responses_total', 'TMDB responses by endpoint and status', ('endpoint', 'status'))
+tmdb_coalesced = Counter('tmdb_coalesced_total', 'TMDB calls that shared another call instead of going out', ('endpoint', 'scope'))
+
+METRICS = [request_latency, request_queries, request_sql_time, sql_queries, tmdb_latency, tmdb_responses, tmdb_coalesced]
+
+
+def add_phase(name, seconds):
+    """Add time to a phase of the current request, for the slow request log."""
+    if has_request_context():
+        phases = g.setdefault('phases', {})
+        phases[name] = phases.get(name, 0) + seconds
+
+
+def tmdb_endpoint(path):
+    """/movie/123/watch/providers -> /movie/{id}/watch/providers"""
+    return re.sub(r'/\d+', '/{id}', path)
+
+
+def record_tmdb(path, status, seconds):
+    """Called by the TMDB client for every attempt, from its loop thread."""
+    endpoint = tmdb_endpoint(path)
+    tmdb_latency.observe(seconds, endpoint)
+    tmdb_responses.inc(endpoint, status or 'error')
+
+
+def record_coalesced(path, scope):
+    """scope is 'worker' for a call shared in process, 'shared' for one another worker made."""
+    tmdb_coalesced.inc(tmdb_endpoint(path), scope)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    sql_queries.inc()
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        add_phase('sql', elapsed)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.append("# TYPE cache_hit_rate gauge")
+    for name, stats in cache_stats().items():
+        if 'hit_rate' in stats:
+            lines.append(f'cache_hit_rate{{cache="{name}"}} {stats["hit_rate"]}')
+            lines.append(f'cache_hits_total{{cache="{name}"}} {stats["hits"]}')
+            lines.append(f'cache_misses_total{{cache="{name}"}} {stats["misses"]}')
+        lines.append(f'cache_entries{{cache="{name}"}} {stats["size"]}')
+
+    lines.append("# TYPE password_pool_queue_depth gauge")
+    lines.append(f"password_pool_queue_depth {password_pool.stats()['queue_depth']}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Hook the timing into the app and add /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.phases = {}
+        g.sql_queries = 0
+
+    @before_render_template.connect_via(app)
+    def start_render(sender, template, context, **extra):
+        g.render_start = time.perf_counter()
+        g.render_sql_start = g.get('phases', {}).get('sql', 0)
+
+    @template_rendered.connect_via(app)
+    def end_render(sender, template, context, **extra):
+        if 'render_start' in g:
+            # Lazy loads during rendering already count as sql, don't count them twice
+            sql = g.get('phases', {}).get('sql', 0) - g.pop('render_sql_start', 0)
+            add_phase('render', time.perf_counter() - g.pop('render_start') - sql)
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'none'
+        request_latency.observe(elapsed, endpoint, request.method, str(response.status_code))
+        request_queries.observe(g.get('sql_queries', 0), endpoint)
+        request_sql_time.observe(g.get('phases', {}).get('sql', 0), endpoint)
+
+        if SLOW_REQUEST_MS and elapsed * 1000 > SLOW_REQUEST_MS:
+            phases = g.get('phases', {})
+            other = elapsed - sum(phases.values())
+            breakdown = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in sorted(phases.items()))
+            app.logger.warning(f"Slow request {request.method} {request.full_path} {elapsed * 1000:.1f}ms: "
+                               f"{breakdown} other={other * 1000:.1f}ms queries={g.get('sql_queries', 0)}")
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
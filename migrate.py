@@ -0,0 +1,197 @@
+"""Brings an existing database up to date with models.py.
+
+connect_db only creates tables that don't exist yet, so new columns and
+indexes on existing tables get added here. Every migration has a version and
+is recorded in schema_migrations once it has run, so each one only runs once.
+They also check first, so databases migrated before there were versions are
+fine too:
+
+    python migrate.py               # run the pending migrations
+    python migrate.py --status      # list them without running anything
+    python migrate.py --explain     # query plans of the hot lookups
+
+Run --explain against realistic data (bench/seed_bench.py), Postgres happily
+scans a table of a few rows even when there's an index for it.
+"""
+import argparse
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select, text
+
+from app import create_app
+from models import db, Movie, Service, Subscription, User_Available_Movie, User_Likes_Movie, SERVICE_BITS, SERVICE_NAME_BITS
+from watchlist import refresh_availability
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register a migration. Versions have to go up, they run in order."""
+
+    def decorator(step):
+        MIGRATIONS.append((version, step))
+        return step
+
+    return decorator
+
+
+def add_column(table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column is already there."""
+    columns = [col['name'] for col in inspect(db.engine).get_columns(table)]
+    if column not in columns:
+        print(f"Adding {table}.{column}")
+        db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl}"))
+        db.session.commit()
+        return True
+    return False
+
+
+def add_indexes(model):
+    for index in model.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def backfill_subscription_masks():
+    """Fill services.bit and users.subscription_mask from the old boolean columns."""
+    for name, bit in SERVICE_NAME_BITS.items():
+        db.session.execute(text("UPDATE services SET bit = :bit WHERE name = :name"),
+                           {'bit': bit, 'name': name})
+    mask = ' + '.join(f"(CASE WHEN {field} THEN {bit} ELSE 0 END)" for field, bit in SERVICE_BITS.items())
+    db.session.execute(text(f"UPDATE users SET subscription_mask = {mask}"))
+    db.session.commit()
+
+
+@migration(1)
+def watchlist_added_at():
+    add_column('user_likes_movies', 'added_at',
+               "added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+    add_indexes(User_Likes_Movie)
+
+
+@migration(2)
+def subscription_masks():
+    added_mask = add_column('users', 'subscription_mask', "subscription_mask INTEGER NOT NULL DEFAULT 0")
+    added_bit = add_column('services', 'bit', "bit INTEGER NOT NULL DEFAULT 0")
+    if added_mask or added_bit:
+        backfill_subscription_masks()
+
+
+@migration(3)
+def movie_search():
+    add_column('movies', 'popularity', "popularity DOUBLE PRECISION NOT NULL DEFAULT 0")
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        db.session.commit()
+    add_indexes(Movie)
+
+
+@migration(4)
+def user_available_movies():
+    # connect_db creates the table, fill it in the first time round
+    add_indexes(User_Available_Movie)
+    if not db.session.query(User_Available_Movie.query.exists()).scalar():
+        print("Filling user_available_movies")
+        refresh_availability()
+        db.session.commit()
+
+
+@migration(5)
+def lookup_indexes():
+    """Unique service names, plus indexes for the lookups the primary keys don't cover."""
+    duplicates = [name for name, in db.session.query(Service.name).group_by(Service.name).having(func.count() > 1)]
+    if duplicates:
+        raise RuntimeError(f"Services {duplicates} are in the table more than once, merge them and migrate again")
+    add_indexes(Service)
+    add_indexes(Subscription)
+    add_indexes(User_Likes_Movie)
+
+
+@migration(6)
+def watchlist_versions():
+    """The watchlist ETag versions moved from a per-worker cache to the users table."""
+    add_column('users', 'watchlist_version', "watchlist_version DOUBLE PRECISION NOT NULL DEFAULT 0")
+
+
+def applied_versions():
+    schema_migrations.create(db.engine, checkfirst=True)
+    return {version for version, in db.session.execute(select(schema_migrations.c.version))}
+
+
+def migrate():
+    applied = applied_versions()
+    for version, step in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        print(f"Migration {version}: {step.__name__}")
+        step()
+        db.session.execute(schema_migrations.insert().values(version=version, name=step.__name__))
+        db.session.commit()
+
+
+def status():
+    applied = applied_versions()
+    for version, step in sorted(MIGRATIONS, key=lambda item: item[0]):
+        print(f"{version:>3} {step.__name__:<25} {'applied' if version in applied else 'pending'}")
+
+
+def hot_queries(user_id=1, movie_id=1):
+    """The lookups on the watchlist and like paths, by name."""
+    return {
+        'watchlist page': select(User_Likes_Movie.liked_movie_id, User_Likes_Movie.added_at)
+            .where(User_Likes_Movie.user_liking_id == user_id)
+            .order_by(User_Likes_Movie.added_at.desc(), User_Likes_Movie.liked_movie_id.desc())
+            .limit(25),
+        'watchlist services': select(User_Available_Movie.movie_id, User_Available_Movie.service_id)
+            .where(User_Available_Movie.user_id == user_id, User_Available_Movie.movie_id.in_([movie_id])),
+        'available to watch': select(User_Available_Movie.movie_id).where(User_Available_Movie.user_id == user_id),
+        'movie by TMDB id': select(Movie.id).where(Movie.movie_id.in_([movie_id])),
+        'services of a movie': select(Subscription.service_id).where(Subscription.movie_id == movie_id),
+        'who liked a movie': select(User_Likes_Movie.user_liking_id).where(User_Likes_Movie.liked_movie_id.in_([movie_id])),
+    }
+
+
+def explain(query):
+    """Query plan lines, and whether every table in it is looked up through an
+    index. On SQLite a SCAN counts as a table scan even when it walks an index."""
+    sql = str(query.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'postgresql':
+        plan = [line for line, in db.session.execute(text(f"EXPLAIN {sql}"))]
+        return plan, not any('Seq Scan' in line for line in plan)
+    plan = [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    return plan, not any(line.startswith('SCAN') for line in plan)
+
+
+def explain_hot_queries():
+    """Print the plan of every hot query. Returns the names of the ones that scan a whole table."""
+    scans = []
+    for name, query in hot_queries().items():
+        plan, indexed = explain(query)
+        print(f"{name}: {'index' if indexed else 'TABLE SCAN'}")
+        for line in plan:
+            print(f"    {line}")
+        if not indexed:
+            scans.append(name)
+    return scans
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--status', action='store_true', help='list the migrations and exit')
+    parser.add_argument('--explain', action='store_true', help='print the hot query plans and exit')
+    args = parser.parse_args()
+
+    app = create_app("stream_tracker_db")
+    with app.app_context():
+        if args.status:
+            status()
+        elif args.explain:
+            raise SystemExit(1 if explain_hot_queries() else 0)
+        else:
+            migrate()
@@ -1,11 +1,35 @@
+import os
+import time
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
+from flask import g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import Session
+
+from passwords import bcrypt, hash_password, check_password, needs_rehash
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Seconds the read replica might be behind the primary, see read_session
+REPLICA_LAG = float(os.environ.get('DATABASE_REPLICA_LAG', 5))
+
+# The User boolean column for each service and its name in the services table.
+# Each one gets a bit in User.subscription_mask, in this order.
+SERVICE_FIELDS = [
+    ('prime_video', 'Amazon Prime Video'),
+    ('netflix', 'Netflix'),
+    ('disney_plus', 'Disney Plus'),
+    ('hbo_max', 'HBO Max'),
+    ('hulu', 'Hulu'),
+    ('peacock', 'Peacock Premium'),
+    ('paramount_plus', 'Paramount Plus'),
+    ('starz', 'Starz'),
+    ('showtime', 'Showtime'),
+    ('apple_tv', 'Apple TV Plus'),
+]
+SERVICE_BITS = {field: 1 << index for index, (field, name) in enumerate(SERVICE_FIELDS)}
+SERVICE_NAME_BITS = {name: 1 << index for index, (field, name) in enumerate(SERVICE_FIELDS)}
+
 class User(db.Model):
     """User model"""
 
@@ -88,9 +112,30 @@ class User(db.Model):
         default=False
     )
 
+    # One bit per service (see SERVICE_BITS), so checking a service is a single
+    # bitwise and, in Python or in SQL
+    subscription_mask = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    # When the watchlist (or what's streaming on it) last changed, as a unix
+    # timestamp. The ETags and Last-Modified of the watchlist pages come from it,
+    # so every worker and the refresher see the same value.
+    watchlist_version = db.Column(
+        db.Float,
+        nullable=False,
+        default=0
+    )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
+
+    def update_subscription_mask(self):
+        """Rebuild subscription_mask from the service boolean columns."""
+        self.subscription_mask = sum(bit for field, bit in SERVICE_BITS.items() if getattr(self, field))
+        return self.subscription_mask
     
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -99,7 +144,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -120,17 +165,40 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the hash was made with an old bcrypt cost it gets rehashed with the
+        current one, so changing BCRYPT_LOG_ROUNDS takes effect as people log in.
         """
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.verify_password(password):
+            return user
 
         return False
+
+    def verify_password(self, password):
+        """True if password is this user's, rehashing it if the bcrypt cost changed."""
+        if not check_password(self.password, password):
+            return False
+        if needs_rehash(self.password):
+            self.password = hash_password(password)
+            db.session.commit()
+        return True
     
+def movie_search_vector(name, description):
+    """Full text search document for a movie. Used by the movies index and by
+    search_index.py, so the expressions have to match exactly."""
+    return db.func.to_tsvector(db.literal_column("'english'"),
+                               name + db.literal_column("' '") + description)
+
+def has_pg_trgm(ddl, target, bind, **kw):
+    """Only create the trigram index once migrate.py has added pg_trgm,
+    creating the extension needs more privileges than the app runs with."""
+    if bind is None:
+        return True
+    return bind.execute(db.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
 class Movie(db.Model):
     """Table for each movie"""
 
@@ -167,10 +235,36 @@ class Movie(db.Model):
         db.Text
     )
 
+    # TMDB popularity when the movie was saved, used to rank local searches
+    popularity = db.Column(
+        db.Float,
+        nullable=False,
+        default=0
+    )
+
+    # Postgres only: full text over name + description, and trigrams for
+    # partial title matches (needs the pg_trgm extension, see migrate.py)
+    __table_args__ = (
+        db.Index('ix_movies_search', movie_search_vector(name, description),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+        db.Index('ix_movies_name_trgm', name, postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}).ddl_if(dialect='postgresql', callable_=has_pg_trgm),
+    )
+
+    services = db.relationship(
+        'Service',
+        secondary='subscriptions',
+        backref='movies'
+    )
+
 class Service(db.Model):
     """The table for each subscription service. Hulu, Netflix, etc."""
 
     __tablename__ = 'services'
+    __table_args__ = (
+        # Looked up by name when saving providers, and there's one row per service
+        db.Index('uq_services_name', 'name', unique=True),
+    )
 
     id = db.Column(
         db.Integer,
@@ -187,10 +281,25 @@ class Service(db.Model):
         nullable=False
     )
 
+    bit = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    @classmethod
+    def in_mask(cls, mask):
+        """SQL filter for the services included in a User.subscription_mask"""
+        return cls.bit.op('&')(mask) != 0
+
 class Subscription(db.Model):
     """Subscription table, connects the ID of the movie and streaming service ID"""
 
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # The primary key covers lookups by movie, this one covers deleting a service
+        db.Index('ix_subscriptions_service', 'service_id'),
+    )
 
     movie_id = db.Column(
         db.Integer,
@@ -208,6 +317,12 @@ class User_Likes_Movie(db.Model):
     """Table for user to put on watch list """
 
     __tablename__ = 'user_likes_movies'
+    __table_args__ = (
+        # Keyset pagination of a user's watchlist, newest first
+        db.Index('ix_user_likes_movies_user_added', 'user_liking_id', 'added_at', 'liked_movie_id'),
+        # Everyone who liked a movie, for provider refreshes and availability
+        db.Index('ix_user_likes_movies_movie', 'liked_movie_id', 'user_liking_id'),
+    )
 
     user_liking_id = db.Column(
         db.Integer,
@@ -221,6 +336,44 @@ class User_Likes_Movie(db.Model):
         primary_key=True
     )
 
+    added_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow
+    )
+
+class User_Available_Movie(db.Model):
+    """Which of a user's liked movies are on which of the services they subscribe to.
+
+    Precomputed from user_likes_movies, subscriptions and users.subscription_mask
+    by watchlist.refresh_availability, so the watchlist badges and "what can I
+    watch" are a lookup on the primary key.
+    """
+
+    __tablename__ = 'user_available_movies'
+    __table_args__ = (
+        # For provider refreshes, which change a movie for everyone who liked it
+        db.Index('ix_user_available_movies_movie', 'movie_id', 'service_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True
+    )
+
+    movie_id = db.Column(
+        db.Integer,
+        db.ForeignKey('movies.id', ondelete="cascade"),
+        primary_key=True
+    )
+
+    service_id = db.Column(
+        db.Integer,
+        db.ForeignKey('services.id', ondelete="cascade"),
+        primary_key=True
+    )
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -229,4 +382,24 @@ def connect_db(app):
     with app.app_context():
         db.app = app
         db.init_app(app)
-        db.create_all()
\ No newline at end of file
+        db.create_all()
+
+
+def read_session(since=None):
+    """Session for read-only queries. Uses the replica if the app has one,
+    otherwise it's just db.session. Replica reads can lag the primary a bit,
+    so pass since (the unix time of the last write the caller needs to see)
+    to read from the primary until REPLICA_LAG seconds after it."""
+    if 'replica' not in db.engines:
+        return db.session
+    if since is not None and time.time() - since < REPLICA_LAG:
+        return db.session
+    if 'replica_session' not in g:
+        g.replica_session = Session(db.engines['replica'])
+    return g.replica_session
+
+
+def close_replica_session():
+    session = g.pop('replica_session', None)
+    if session is not None:
+        session.close()
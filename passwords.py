@@ -0,0 +1,56 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+# bcrypt releases the GIL, so a few threads can hash while the request
+# threads keep serving, but never more than this many at once per worker.
+POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', 2))
+
+
+class PasswordPool:
+    """Bounded thread pool for bcrypt work, with a count of how many jobs are
+    waiting or running so we can see a login storm coming."""
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='bcrypt')
+        self.depth = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        with self._lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self.depth -= 1
+
+    def stats(self):
+        return {'pool_size': self.size, 'queue_depth': self.depth, 'max_queue_depth': self.max_depth}
+
+
+pool = PasswordPool()
+
+
+def hash_password(password):
+    return pool.run(bcrypt.generate_password_hash, password).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    return pool.run(bcrypt.check_password_hash, hashed, password)
+
+
+def needs_rehash(hashed):
+    """True if the hash was made with a different cost than we use now."""
+    try:
+        return int(hashed.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
+    except (IndexError, ValueError):
+        return True
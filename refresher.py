@@ -0,0 +1,96 @@
+"""Keeps the subscriptions table in line with what TMDB says is streaming.
+
+Re-fetches /watch/providers for every movie in the database, most watchlisted
+first, in rate limited batches, and only writes the subscription rows that
+changed. Run it as its own worker process:
+
+    python refresher.py             # loop forever, every REFRESH_INTERVAL seconds
+    python refresher.py --once      # one pass and exit
+"""
+import argparse
+import time
+
+from sqlalchemy import func
+
+from app import create_app
+from models import db, Movie, Subscription, User, User_Likes_Movie
+from tmdb import client as tmdb_client
+from watchlist import bump_watchlist_version, insert, refresh_availability, service_ids
+
+BATCH_SIZE = 50
+REFRESH_INTERVAL = 60 * 60 * 6
+
+
+def movies_by_popularity():
+    """Movie ids (ours and TMDB's), the ones on the most watchlists first."""
+    likes = func.count(User_Likes_Movie.user_liking_id)
+    return (db.session.query(Movie.id, Movie.movie_id)
+            .outerjoin(User_Likes_Movie, User_Likes_Movie.liked_movie_id == Movie.id)
+            .group_by(Movie.id, Movie.movie_id)
+            .order_by(likes.desc(), Movie.id)
+            .all())
+
+
+def refresh_batch(batch):
+    """Refresh one batch of (id, movie_id) rows. Returns (added, removed) counts.
+
+    Movies whose lookup failed are left alone, so a TMDB outage doesn't wipe
+    out everyone's badges.
+    """
+    movies = [{'id': movie_id, 'pk': pk} for pk, movie_id in batch]
+    movies = tmdb_client.run(tmdb_client.add_providers(movies, fresh=True))
+    services = service_ids()
+
+    refreshed = [movie['pk'] for movie in movies if not movie.get('providers_unknown')]
+    wanted = {
+        (movie['pk'], services[provider.get('provider_name')])
+        for movie in movies if not movie.get('providers_unknown')
+        for provider in movie.get('flatrate') or []
+        if provider.get('provider_name') in services
+    }
+    current = set(db.session.query(Subscription.movie_id, Subscription.service_id)
+                  .filter(Subscription.movie_id.in_(refreshed)).all())
+
+    added = wanted - current
+    removed = current - wanted
+    if added:
+        db.session.execute(insert(Subscription).values([
+            {'movie_id': movie_id, 'service_id': service_id} for movie_id, service_id in added
+        ]).on_conflict_do_nothing())
+    if removed:
+        db.session.execute(Subscription.__table__.delete().where(
+            db.tuple_(Subscription.movie_id, Subscription.service_id).in_(removed)))
+
+    changed = {movie_id for movie_id, service_id in added | removed}
+    if changed:
+        refresh_availability(movie_ids=list(changed))
+        likers = db.select(User_Likes_Movie.user_liking_id).where(User_Likes_Movie.liked_movie_id.in_(changed))
+        bump_watchlist_version(User.id.in_(likers))
+    db.session.commit()
+    return added, removed
+
+
+def refresh_all(batch_size=BATCH_SIZE):
+    movies = movies_by_popularity()
+    total_added = total_removed = 0
+    for start in range(0, len(movies), batch_size):
+        added, removed = refresh_batch(movies[start:start + batch_size])
+        total_added += len(added)
+        total_removed += len(removed)
+    print(f"Refreshed {len(movies)} movies: {total_added} subscriptions added, {total_removed} removed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--once', action='store_true', help='do one pass and exit')
+    parser.add_argument('--interval', type=int, default=REFRESH_INTERVAL, help='seconds between passes')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    app = create_app("stream_tracker_db")
+    with app.app_context():
+        while True:
+            refresh_all(args.batch_size)
+            if args.once:
+                break
+            time.sleep(args.interval)
@@ -0,0 +1,109 @@
+import re
+import threading
+import time
+
+from sqlalchemy import or_
+
+from cache import movie_cache
+from models import db, Movie, movie_search_vector
+
+# Serve a search locally once we have this many matches (or an exact title match)
+LOCAL_MIN_RESULTS = 5
+LOCAL_LIMIT = 20
+
+
+def tokenize(text):
+    return re.findall(r"\w+", (text or '').lower())
+
+
+class LocalIndex:
+    """In-process inverted index over movie names and descriptions, for
+    databases without Postgres full text search (SQLite in tests). Rebuilt
+    from the movies table when it's older than max_age seconds."""
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.built = 0
+        self.tokens = {}
+        self.popularity = {}
+        self._lock = threading.Lock()
+
+    def build(self):
+        tokens = {}
+        popularity = {}
+        rows = db.session.query(Movie.id, Movie.name, Movie.description, Movie.popularity).all()
+        for movie_id, name, description, movie_popularity in rows:
+            popularity[movie_id] = movie_popularity or 0
+            for token in set(tokenize(name) + tokenize(description)):
+                tokens.setdefault(token, set()).add(movie_id)
+        with self._lock:
+            self.tokens = tokens
+            self.popularity = popularity
+            self.built = time.monotonic()
+
+    def search(self, query, limit=LOCAL_LIMIT):
+        """Ids of the movies matching every word in the query, most popular first."""
+        if time.monotonic() - self.built > self.max_age:
+            self.build()
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._lock:
+            matches = set.intersection(*[self.tokens.get(word, set()) for word in words])
+            return sorted(matches, key=lambda movie_id: self.popularity[movie_id], reverse=True)[:limit]
+
+
+local_index = LocalIndex()
+
+
+def search_movies(query, limit=LOCAL_LIMIT):
+    """Movies in our own table matching the query, most popular first.
+    Postgres uses the full text and trigram indexes, anything else the in-process index."""
+    if db.engine.dialect.name == 'postgresql':
+        return (Movie.query
+                .filter(or_(movie_search_vector(Movie.name, Movie.description).op('@@')(db.func.plainto_tsquery(db.literal_column("'english'"), query)),
+                            Movie.name.icontains(query, autoescape=True)))
+                .options(db.selectinload(Movie.services))
+                .order_by(Movie.popularity.desc())
+                .limit(limit)
+                .all())
+
+    ids = local_index.search(query, limit)
+    if not ids:
+        return []
+    movies = {movie.id: movie for movie in
+              Movie.query.filter(Movie.id.in_(ids)).options(db.selectinload(Movie.services)).all()}
+    return [movies[movie_id] for movie_id in ids if movie_id in movies]
+
+
+def as_search_result(movie):
+    """A Movie in the same shape as a TMDB search result with providers."""
+    return {
+        'id': movie.movie_id,
+        'title': movie.name,
+        'overview': movie.description,
+        'poster_path': movie.image_url,
+        'release_date': movie.year,
+        'popularity': movie.popularity,
+        'flatrate': [{
+            'provider_name': service.name,
+            'logo_path': '/' + service.image_url.rsplit('/', 1)[-1],
+        } for service in movie.services] or None,
+    }
+
+
+def local_search(query):
+    """Search results straight from the database if it can answer this query
+    well, otherwise None and the caller should go to TMDB."""
+    query = (query or '').strip()
+    if not query:
+        return None
+    movies = search_movies(query)
+    exact = any(movie.name.lower() == query.lower() for movie in movies)
+    if len(movies) < LOCAL_MIN_RESULTS and not exact:
+        return None
+
+    results = [as_search_result(movie) for movie in movies]
+    for result in results:
+        movie_cache.set(result['id'], {key: value for key, value in result.items() if key != 'flatrate'})
+    return results
@@ -1,7 +1,11 @@
+import sys
+
 from app import create_app
-from models import db, Service
+from models import db, Service, SERVICE_NAME_BITS
+from snapshot import import_snapshot
 
 app = create_app("stream_tracker_db", testing = False)
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -17,5 +21,14 @@ starz = Service(name="Starz", image_url="https://image.tmdb.org/t/p/original/yIK
 showtime = Service(name="Showtime", image_url="https://image.tmdb.org/t/p/original/kkUHFtdjasnnOknZN69TbZ2fCTh.jpg")
 apple = Service(name="Apple TV Plus", image_url="https://image.tmdb.org/t/p/original/2E03IAZsX4ZaUqM7tXlctEPMGWS.jpg")
 
-db.session.add_all([amazon, netflix, disney, hbo, hulu, peacock, paramount, starz, showtime, apple])
-db.session.commit()
\ No newline at end of file
+services = [amazon, netflix, disney, hbo, hulu, peacock, paramount, starz, showtime, apple]
+for service in services:
+    service.bit = SERVICE_NAME_BITS[service.name]
+
+db.session.add_all(services)
+db.session.commit()
+
+# python seed.py providers.snap also loads the movies and their providers
+# from a snapshot (see snapshot.py), instead of starting with an empty table
+if len(sys.argv) > 1:
+    print(import_snapshot(sys.argv[1]))
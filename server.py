@@ -1,5 +1,3 @@
 from app import create_app
-from models import connect_db
 
-app = create_app("stream_tracker_db")
-connect_db(app)
\ No newline at end of file
+app = create_app("stream_tracker_db")
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""Dump and load the movies, services and subscriptions tables in one file.
+
+Lets a new environment or test database start with provider data without
+re-crawling TMDB one movie at a time:
+
+    python snapshot.py export providers.snap
+    python snapshot.py import providers.snap
+
+The file is columnar: a JSON manifest, then every column as one contiguous
+little-endian array (text columns as an offsets array plus a UTF-8 blob).
+Loading mmaps the file and reads the columns in place, and on Postgres the
+rows go in with COPY. Movies are matched by TMDB id and services by name, so
+the file can go into a database that already has some of them.
+"""
+import argparse
+import io
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+from sqlalchemy import select
+
+from app import create_app
+from models import db, Movie, Service, Subscription
+import watchlist
+
+MAGIC = b'STSNAP1\n'
+# Parents first, the subscriptions are matched up through them
+MODELS = [Service, Movie, Subscription]
+TYPES = {int: 'int', float: 'float', str: 'text'}
+ARRAY_CODES = {'int': 'q', 'float': 'd'}
+CHUNK_ROWS = 50000
+
+
+def little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_column(kind, values):
+    """Column values -> {section name: bytes}"""
+    sections = {}
+    if any(value is None for value in values):
+        sections['nulls'] = bytes(value is None for value in values)
+    if kind == 'text':
+        blob = bytearray()
+        offsets = array('q', [0])
+        for value in values:
+            blob += (value or '').encode('utf-8')
+            offsets.append(len(blob))
+        sections['offsets'] = little_endian(offsets)
+        sections['data'] = bytes(blob)
+    else:
+        cast = int if kind == 'int' else float
+        sections['values'] = little_endian(array(ARRAY_CODES[kind], [cast(value or 0) for value in values]))
+    return sections
+
+
+def export_snapshot(path):
+    """Write the tables in MODELS to path. Returns {table: row count}."""
+    manifest = {'tables': {}}
+    blobs = []
+    offset = 0
+
+    for model in MODELS:
+        table = model.__table__
+        columns = list(table.columns)
+        rows = db.session.execute(select(*columns).order_by(*table.primary_key.columns)).all()
+        info = {'rows': len(rows), 'columns': {}}
+        for index, column in enumerate(columns):
+            kind = TYPES[column.type.python_type]
+            sections = encode_column(kind, [row[index] for row in rows])
+            info['columns'][column.name] = {'type': kind, 'sections': {}}
+            for name, blob in sections.items():
+                info['columns'][column.name]['sections'][name] = [offset, len(blob)]
+                # Keep every section 8 byte aligned so it can be cast in place
+                padding = -len(blob) % 8
+                blobs.append(blob + b'\0' * padding)
+                offset += len(blob) + padding
+        manifest['tables'][table.name] = info
+
+    header = json.dumps(manifest).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    return {name: info['rows'] for name, info in manifest['tables'].items()}
+
+
+class Column:
+    """One column of a snapshot, read straight out of the mmap."""
+
+    def __init__(self, buffer, kind, sections):
+        self.kind = kind
+
+        def section(name):
+            start, length = sections[name]
+            return buffer[start:start + length]
+
+        self.nulls = section('nulls') if 'nulls' in sections else None
+        if kind == 'text':
+            self.offsets = self._array(section('offsets'), 'q')
+            self.data = section('data')
+        else:
+            self.values = self._array(section('values'), ARRAY_CODES[kind])
+
+    @staticmethod
+    def _array(view, code):
+        if sys.byteorder == 'big':
+            values = array(code, view.tobytes())
+            values.byteswap()
+            return values
+        return view.cast(code)
+
+    def __getitem__(self, row):
+        if self.nulls is not None and self.nulls[row]:
+            return None
+        if self.kind == 'text':
+            return str(self.data[self.offsets[row]:self.offsets[row + 1]], 'utf-8')
+        return self.values[row]
+
+
+class Snapshot:
+    """A snapshot file opened with mmap. Use it as a context manager."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a snapshot file")
+        start = len(MAGIC) + 8
+        header_length, = struct.unpack('<Q', self.mmap[len(MAGIC):start])
+        self.manifest = json.loads(self.mmap[start:start + header_length])
+        self.buffer = memoryview(self.mmap)[start + header_length:]
+
+    def rows(self, table_name, column_names):
+        info = self.manifest['tables'].get(table_name, {'rows': 0, 'columns': {}})
+        columns = [Column(self.buffer, info['columns'][name]['type'], info['columns'][name]['sections'])
+                   for name in column_names]
+        for row in range(info['rows']):
+            yield tuple(column[row] for column in columns)
+        # Drop the views into the mmap so it can be closed
+        del columns
+
+    def column_names(self, table):
+        """Columns both the snapshot and the current table have."""
+        stored = self.manifest['tables'].get(table.name, {}).get('columns', {})
+        return [column.name for column in table.columns if column.name in stored]
+
+    def close(self):
+        if getattr(self, 'buffer', None) is not None:
+            self.buffer.release()
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def chunks(rows, size=CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def copy_value(value):
+    """A value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def staging_table(table, column_names):
+    """A temp table with the snapshot's columns of table and no constraints,
+    so the snapshot's own ids can go in as they are."""
+    return db.Table(f"snapshot_{table.name}", db.MetaData(),
+                    *[db.Column(name, table.columns[name].type) for name in column_names],
+                    prefixes=['TEMPORARY'])
+
+
+def copy_rows(staging, column_names, rows):
+    columns = ', '.join(column_names)
+    cursor = db.session.connection().connection.cursor()
+    for chunk in chunks(rows):
+        buffer = io.StringIO()
+        for row in chunk:
+            buffer.write('\t'.join(copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {staging.name} ({columns}) FROM STDIN", buffer)
+
+
+def insert_rows(staging, column_names, rows):
+    for chunk in chunks(rows, 1000):
+        db.session.execute(staging.insert(), [dict(zip(column_names, row)) for row in chunk])
+
+
+def merge_parent(model, staging, key):
+    """Insert the staged rows whose key (a unique column) isn't in the table
+    yet, leaving the ids to the database."""
+    column_names = [name for name in staging.columns.keys() if name != 'id']
+    rows = select(*[staging.columns[name] for name in column_names]).where(staging.columns[key].isnot(None))
+    db.session.execute(watchlist.insert(model).from_select(column_names, rows)
+                       .on_conflict_do_nothing(index_elements=[key]))
+
+
+def merge_subscriptions(staged):
+    """Insert the staged subscriptions, with the snapshot's movie and service
+    ids swapped for the ones in this database via the TMDB id and the name."""
+    movies, services, subscriptions = staged['movies'], staged['services'], staged['subscriptions']
+    rows = (select(Movie.id, Service.id)
+            .select_from(subscriptions)
+            .join(movies, movies.c.id == subscriptions.c.movie_id)
+            .join(Movie, Movie.movie_id == movies.c.movie_id)
+            .join(services, services.c.id == subscriptions.c.service_id)
+            .join(Service, Service.name == services.c.name)
+            # SQLite needs a WHERE to tell the ON CONFLICT apart from the joins
+            .where(subscriptions.c.movie_id.isnot(None)))
+    db.session.execute(watchlist.insert(Subscription).from_select(['movie_id', 'service_id'], rows)
+                       .on_conflict_do_nothing())
+
+
+def import_snapshot(path):
+    """Load a snapshot into the database in one transaction. Returns {table: row count in the file}.
+
+    The snapshot's ids are only used to connect its own rows: movies are
+    matched to this database by TMDB id and services by name, and the ones
+    already here are kept as they are."""
+    counts = {}
+    staged = {}
+    with Snapshot(path) as snapshot:
+        for model in MODELS:
+            table = model.__table__
+            column_names = snapshot.column_names(table)
+            counts[table.name] = snapshot.manifest['tables'].get(table.name, {}).get('rows', 0)
+            staging = staged[table.name] = staging_table(table, column_names)
+            staging.create(db.session.connection())
+            rows = snapshot.rows(table.name, column_names)
+            if db.engine.dialect.name == 'postgresql':
+                copy_rows(staging, column_names, rows)
+            else:
+                insert_rows(staging, column_names, rows)
+
+        merge_parent(Service, staged['services'], 'name')
+        merge_parent(Movie, staged['movies'], 'movie_id')
+        merge_subscriptions(staged)
+        for staging in staged.values():
+            staging.drop(db.session.connection())
+        # Anyone who already liked these movies can now see where they're streaming.
+        # Imports are rare, so every watchlist gets a new version and ETag.
+        watchlist.refresh_availability()
+        watchlist.bump_watchlist_version()
+        db.session.commit()
+    # New services might have been added
+    watchlist._service_ids.clear()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    app = create_app("stream_tracker_db")
+    with app.app_context():
+        if args.command == 'export':
+            counts = export_snapshot(args.path)
+        else:
+            counts = import_snapshot(args.path)
+        print(', '.join(f"{count} {table}" for table, count in counts.items()))
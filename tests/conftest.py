@@ -0,0 +1,77 @@
+"""Tests run on an in-memory SQLite database (or TEST_DATABASE_URL) and never call TMDB."""
+import os
+
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+# Nothing listens here, so a test that reaches TMDB fails fast
+os.environ['TMDB_BASE_URL'] = 'http://127.0.0.1:9/3'
+
+import pytest
+
+from app import create_app, CURR_USER_KEY
+from cache import movie_cache, provider_cache, search_cache, user_cache
+from models import db, Movie, Service, Subscription, User, User_Likes_Movie, SERVICE_FIELDS, SERVICE_NAME_BITS
+import watchlist
+
+
+@pytest.fixture
+def app():
+    app = create_app("stream_tracker_test", testing=True, bcrypt_rounds=4, production=True)
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+    # Ids start over in every test, don't let these point at the last one's rows
+    for cache in [user_cache, search_cache, provider_cache, movie_cache]:
+        cache.local.clear()
+    watchlist._service_ids.clear()
+
+
+@pytest.fixture
+def services(app):
+    services = [Service(name=name, image_url=f"/{field}.jpg", bit=SERVICE_NAME_BITS[name])
+                for field, name in SERVICE_FIELDS]
+    db.session.add_all(services)
+    db.session.commit()
+    return {service.name: service for service in services}
+
+
+@pytest.fixture
+def user(app, services):
+    user = User.signup("testuser", "test@example.com", "password", "/static/images/default-pic.png")
+    user.netflix = True
+    user.hulu = True
+    user.update_subscription_mask()
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as user."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = user.id
+    return client
+
+
+def add_movies(count, start=1, services=()):
+    """count movies with TMDB ids from start on, each streaming on services."""
+    movies = [Movie(movie_id=tmdb_id, name=f"Movie {tmdb_id}", description="A movie",
+                    image_url=f"/poster{tmdb_id}.jpg", year="2020")
+              for tmdb_id in range(start, start + count)]
+    db.session.add_all(movies)
+    db.session.flush()
+    db.session.add_all(Subscription(movie_id=movie.id, service_id=service.id)
+                       for movie in movies for service in services)
+    db.session.commit()
+    return movies
+
+
+def like(user, movies):
+    db.session.add_all(User_Likes_Movie(user_liking_id=user.id, liked_movie_id=movie.id) for movie in movies)
+    watchlist.refresh_availability(user.id)
+    db.session.commit()
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy import inspect, text
+
+from bench.seed_bench import seed
+from migrate import explain, hot_queries
+from models import db
+
+
+@pytest.fixture
+def seeded(app):
+    # Enough rows that a table scan would be the slow plan
+    seed(users=20, movies=2000, likes=100)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("ANALYZE"))
+
+
+@pytest.mark.parametrize('name', list(hot_queries()))
+def test_hot_queries_use_an_index(seeded, name):
+    plan, indexed = explain(hot_queries()[name])
+    assert indexed, '\n'.join(plan)
+
+
+def test_service_names_are_unique(app):
+    # Ten rows get scanned whatever the indexes are, what matters there is one row per name
+    indexes = {index['name']: index for index in inspect(db.engine).get_indexes('services')}
+    assert indexes['uq_services_name']['unique']
+    assert indexes['uq_services_name']['column_names'] == ['name']
@@ -0,0 +1,35 @@
+from cache import movie_cache, provider_cache
+
+
+def cache_movie(tmdb_id, title=None):
+    """Put a movie where resolve_movies finds it without calling TMDB."""
+    movie_cache.set(tmdb_id, {'id': tmdb_id, 'title': title, 'overview': '', 'poster_path': '/p.jpg',
+                              'release_date': '2020', 'popularity': 1})
+    provider_cache.set(tmdb_id, {'flatrate': [{'provider_name': 'Netflix', 'logo_path': '/n.jpg'}]})
+
+
+def test_bulk_counts_only_new_likes(client):
+    for tmdb_id in [1, 2, 3]:
+        cache_movie(tmdb_id, f"Movie {tmdb_id}")
+
+    response = client.post('/movies/like/bulk', json={'ids': [1, 2]})
+    assert response.json['added'] == 2
+
+    response = client.post('/movies/like/bulk', json={'ids': [1, 2, 3]})
+    assert response.status_code == 200
+    assert response.json['added'] == 1
+
+
+def test_like_without_a_title(client):
+    cache_movie(4)
+    response = client.post('/movies/like', data={'add_watchlist': 4})
+    assert response.status_code == 404
+
+    response = client.post('/movies/like/bulk', json={'ids': [4]})
+    assert response.status_code == 404
+
+
+def test_like_twice(client):
+    cache_movie(5, "Five")
+    assert client.post('/movies/like', data={'add_watchlist': 5}).json['message'] == 'Added Five to watchlist!'
+    assert client.post('/movies/like', data={'add_watchlist': 5}).json['message'] == 'Five is already on your watchlist'
@@ -0,0 +1,15 @@
+from models import db, User
+from passwords import bcrypt
+
+
+def test_login_rehashes_with_the_current_cost(app, user):
+    # Hashed before BCRYPT_LOG_ROUNDS went down to the tests' 4
+    user.password = bcrypt.generate_password_hash("password", rounds=5).decode('UTF-8')
+    db.session.commit()
+
+    assert User.authenticate("testuser", "password")
+    assert db.session.get(User, user.id).password.split('$')[2] == '04'
+
+    password = db.session.get(User, user.id).password
+    assert User.authenticate("testuser", "password")
+    assert db.session.get(User, user.id).password == password
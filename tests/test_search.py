@@ -0,0 +1,29 @@
+import json
+
+from cache import provider_cache, search_cache
+
+
+def events(response):
+    return [chunk for chunk in response.get_data(as_text=True).split('\n\n') if chunk]
+
+
+def test_provider_stream_without_the_results_token(client):
+    """Another worker served /search, so the token isn't in this one's result store."""
+    movies = [{'id': 1, 'title': 'One', 'popularity': 2}, {'id': 2, 'title': 'Two', 'popularity': 1}]
+    search_cache.set('test search:1', {'results': movies, 'total_pages': 1})
+    provider_cache.set(1, {'flatrate': [{'provider_name': 'Netflix', 'logo_path': '/n.jpg'}]})
+    provider_cache.set(2, {'flatrate': None})
+
+    response = client.get('/search/providers?token=elsewhere&q=Test+search&page=1')
+
+    data = [json.loads(event[len('data: '):]) for event in events(response) if event.startswith('data: ')]
+    assert {movie['id']: movie['flatrate'] for movie in data} == {
+        1: [{'provider_name': 'Netflix', 'logo_path': '/n.jpg'}], 2: None}
+    assert events(response)[-1] == 'event: done\ndata: {}'
+
+
+def test_search_doesnt_touch_the_session(app, client):
+    search_cache.set('nothing stored:1', {'results': [], 'total_pages': 0})
+    response = client.get('/search?q=nothing+stored&source=tmdb')
+    assert response.status_code == 200
+    assert 'Set-Cookie' not in response.headers
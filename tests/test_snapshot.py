@@ -0,0 +1,81 @@
+from sqlalchemy import select
+
+from models import db, Movie, Service, Subscription, User_Available_Movie
+from snapshot import export_snapshot, import_snapshot
+from tests.conftest import add_movies, like
+
+
+def providers():
+    """{TMDB id: set of service names}, which is what has to survive an import."""
+    rows = db.session.execute(select(Movie.movie_id, Service.name)
+                              .join(Subscription, Subscription.movie_id == Movie.id)
+                              .join(Service, Service.id == Subscription.service_id))
+    result = {}
+    for tmdb_id, name in rows:
+        result.setdefault(tmdb_id, set()).add(name)
+    return result
+
+
+def test_import_remaps_ids(app, services, tmp_path):
+    add_movies(3, start=100, services=[services['Netflix']])
+    add_movies(2, start=200, services=[services['Hulu'], services['Starz']])
+    expected = providers()
+    path = tmp_path / 'providers.snap'
+    export_snapshot(path)
+    rows = [(service.name, service.image_url, service.bit) for service in services.values()]
+
+    # A database where the same ids belong to other rows
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    db.session.add_all(Service(name=name, image_url=image_url, bit=bit) for name, image_url, bit in reversed(rows))
+    db.session.commit()
+    add_movies(4, start=900)
+
+    counts = import_snapshot(path)
+
+    assert counts == {'services': 10, 'movies': 5, 'subscriptions': 7}
+    assert {tmdb_id: names for tmdb_id, names in providers().items() if tmdb_id < 900} == expected
+    assert Movie.query.count() == 9
+    assert Service.query.count() == 10
+
+
+def test_import_keeps_rows_already_there(app, services, user, tmp_path):
+    add_movies(2, start=100, services=[services['Netflix']])
+    path = tmp_path / 'providers.snap'
+    export_snapshot(path)
+
+    # The same movies under other ids, one of them already liked without any providers
+    db.session.execute(Subscription.__table__.delete())
+    db.session.execute(Movie.__table__.delete())
+    db.session.commit()
+    add_movies(1, start=500)
+    movie, = add_movies(1, start=101)
+    movie.name = "Already here"
+    like(user, [movie])
+
+    import_snapshot(path)
+    import_snapshot(path)
+
+    assert providers() == {100: {'Netflix'}, 101: {'Netflix'}}
+    assert Movie.query.count() == 3
+    assert db.session.get(Movie, movie.id).name == "Already here"
+    # The liked movie showed up on one of the user's services
+    assert db.session.execute(select(User_Available_Movie.movie_id)
+                              .where(User_Available_Movie.user_id == user.id)).scalars().all() == [movie.id]
+
+
+def test_import_changes_the_watchlist_etag(app, services, user, client, tmp_path):
+    add_movies(1, start=100, services=[services['Netflix']])
+    path = tmp_path / 'providers.snap'
+    export_snapshot(path)
+    db.session.execute(Subscription.__table__.delete())
+    db.session.commit()
+    like(user, Movie.query.all())
+
+    etag = client.get('/watchlist').headers['ETag']
+    import_snapshot(path)
+
+    response = client.get('/watchlist', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
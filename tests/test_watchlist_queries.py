@@ -0,0 +1,42 @@
+import pytest
+
+from metrics import sql_queries
+from tests.conftest import add_movies, like
+
+
+def queries(client, url):
+    """Status of GET url and the statements it ran, counted by the hooks in metrics.py."""
+    before = sql_queries.series.get((), 0)
+    response = client.get(url)
+    return response.status_code, sql_queries.series.get((), 0) - before
+
+
+@pytest.mark.parametrize('url', ['/watchlist', '/watchlist?available=1', '/api/watchlist?limit=100'])
+def test_watchlist_queries_dont_grow_with_the_list(app, services, user, client, url):
+    # The first request also loads the user into user_cache
+    client.get(url)
+    counts = []
+    start = 1
+    for size in [1, 200]:
+        # Half of them (and the single one) on one of the user's services
+        available = size - size // 2
+        movies = add_movies(available, start, [services['Netflix'], services['Starz']])
+        movies += add_movies(size - available, start + available, [services['Starz']])
+        like(user, movies)
+        start += size
+        status, count = queries(client, url)
+        assert status == 200
+        counts.append(count)
+
+    assert counts[0] == counts[1]
+    # The version check, the page and its services
+    assert counts[1] <= 3
+
+
+@pytest.mark.parametrize('limit, results', [(-5, 1), (-1, 1), (0, 3), (1, 1)])
+def test_watchlist_limit_below_one(app, services, user, client, limit, results):
+    # 0 is no limit given, so the default page size
+    like(user, add_movies(3))
+    response = client.get(f'/api/watchlist?limit={limit}')
+    assert response.status_code == 200
+    assert len(response.json['results']) == results
@@ -0,0 +1,399 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from operator import itemgetter
+
+import aiohttp
+
+import metrics
+from cache import search_cache, provider_cache, movie_cache
+from typeahead import suggestions
+
+
+TMDB_URL = os.environ.get('TMDB_BASE_URL', 'https://api.themoviedb.org/3')
+HEADERS = {"accept": "application/json"}
+if os.environ.get('TMDB_API_KEY'):
+    HEADERS["Authorization"] = os.environ.get('TMDB_API_KEY')
+
+
+# TMDB allows roughly 50 requests a second, stay a bit under that per worker.
+RATE_LIMIT = float(os.environ.get('TMDB_RATE_LIMIT', 40))
+MAX_IN_FLIGHT = int(os.environ.get('TMDB_MAX_IN_FLIGHT', 10))
+REQUEST_TIMEOUT = float(os.environ.get('TMDB_REQUEST_TIMEOUT', 3))
+RETRIES = int(os.environ.get('TMDB_RETRIES', 3))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# TMDB won't go past page 500. We prefetch this many pages ahead of the one shown.
+MAX_PAGES = 500
+PREFETCH_PAGES = int(os.environ.get('TMDB_PREFETCH_PAGES', 2))
+# How long to wait on another worker's call for the same thing before making our own
+FLIGHT_WAIT = float(os.environ.get('TMDB_FLIGHT_WAIT', REQUEST_TIMEOUT))
+
+
+class TokenBucket:
+    """Token bucket rate limiter. Lives on the client loop so every request
+    from this worker shares it."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def level(self):
+        """How full the bucket is right now, 0 to 1, without taking anything."""
+        tokens = self.tokens + (time.monotonic() - self.updated) * self.rate
+        return min(self.capacity, tokens) / self.capacity
+
+
+def backoff(attempt, base=0.25, cap=4.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def cache_io(cache, func, *args, **kwargs):
+    """Call func for cache. With a shared backend that's a blocking redis call,
+    so it runs on a thread rather than holding up the loop every request in
+    the worker shares. The in-process caches are called straight away."""
+    if cache.shared is None:
+        return func(*args, **kwargs)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def unknown_providers(movie):
+    movie['flatrate'] = None
+    movie['providers_unknown'] = True
+    return movie
+
+
+class TMDBClient:
+    """Long lived HTTP client for TMDB, one per worker process.
+
+    Runs its own event loop on a background thread and keeps a single
+    aiohttp.ClientSession on it, so connections, TLS sessions and DNS lookups
+    get reused between requests instead of being set up for every search.
+    """
+
+    def __init__(self, base_url=TMDB_URL, limit=100, limit_per_host=20,
+                 rate_limit=RATE_LIMIT, max_in_flight=MAX_IN_FLIGHT,
+                 timeout=REQUEST_TIMEOUT, retries=RETRIES):
+        self.base_url = base_url
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.bucket = TokenBucket(rate_limit)
+        self.max_in_flight = max_in_flight
+        self._semaphore = None
+        self._prefetching = set()
+        self._in_flight = {}
+        self._claimed = set()
+        self._loop = None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        """Start the loop thread. Also restarts it after a fork (gunicorn preload),
+        since threads don't survive into the child process."""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='tmdb-client', daemon=True)
+            thread.start()
+            self._loop = loop
+            self._session = None
+            self._semaphore = None
+            self._in_flight = {}
+            self._claimed = set()
+            self._pid = os.getpid()
+            return loop
+
+    def run(self, coro):
+        """Run a coroutine on the client loop and wait for the result. The
+        caller's contextvars (Flask's request, g, session) go with it."""
+        loop = self._ensure_loop()
+        if self.on_loop():
+            coro.close()
+            raise RuntimeError("TMDBClient.run called from its own loop, await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(headers=HEADERS, connector=connector)
+        return self._session
+
+    async def get_json(self, path, params=None):
+        """GET a TMDB path. Returns (status, json body or None).
+
+        Identical calls made while one is already in flight wait for that one
+        and share its result, so a burst of searches for the same title only
+        goes out once. The body is shared too, so don't modify it.
+        """
+        key = (path, tuple(sorted((params or {}).items())))
+        flight = self._in_flight.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._get_json(path, params))
+            self._in_flight[key] = flight
+            flight.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            metrics.record_coalesced(path, 'worker')
+        # One caller giving up (a deadline) mustn't cancel the call for the rest
+        return await asyncio.shield(flight)
+
+    async def _get_json(self, path, params=None):
+        """The actual GET behind get_json.
+
+        Every call waits on the rate limiter and the in-flight semaphore, and
+        429/5xx responses or timeouts are retried with jittered backoff. The
+        status is None if the last attempt timed out or failed to connect.
+        """
+        session = await self.session()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        status = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff(attempt))
+            await self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    async with session.get(f"{self.base_url}{path}", params=params, timeout=timeout) as response:
+                        status = response.status
+                        if status == 200:
+                            return status, await response.json()
+                        if status not in RETRY_STATUSES:
+                            return status, None
+            except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+                print(f"TMDB request to {path} failed: {e!r}")
+                status = None
+            finally:
+                metrics.record_tmdb(path, status, time.perf_counter() - start)
+        return status, None
+
+    async def from_peer(self, cache, key, path):
+        """Across workers: if another worker is already fetching key, wait for
+        its result to show up in the shared cache. Returns (value, claimed).
+        With no value, go fetch it, and if claimed call release() once it's
+        stored. Calls this worker is already making are left to get_json."""
+        if (cache.name, key) in self._claimed:
+            return None, False
+        # Marked before the await, so other calls from this worker go straight to get_json
+        self._claimed.add((cache.name, key))
+        if await cache_io(cache, cache.claim, key, FLIGHT_WAIT):
+            return None, True
+        self._claimed.discard((cache.name, key))
+        deadline = time.monotonic() + FLIGHT_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            value = await cache_io(cache, cache.get, key, record=False)
+            if value is not None:
+                metrics.record_coalesced(path, 'shared')
+                return value, False
+        return None, False
+
+    async def release(self, cache, key):
+        self._claimed.discard((cache.name, key))
+        await cache_io(cache, cache.release, key)
+
+    async def search_page(self, query, page=1):
+        """One page of TMDB search results and the total number of pages, sorted
+        by popularity so the most popular movie in the search is displayed first."""
+        cache_key = f"{(query or '').strip().lower()}:{page}"
+        cached, claimed = await cache_io(search_cache, search_cache.get, cache_key), False
+        if cached is None:
+            cached, claimed = await self.from_peer(search_cache, cache_key, '/search/movie')
+        if cached is not None:
+            return cached['results'], cached['total_pages']
+
+        params = {'query': query or '', 'include_adult': 'false', 'language': 'en-US', 'page': page}
+        try:
+            status, result = await self.get_json('/search/movie', params)
+            if status != 200:
+                print(f"Failed to search for {query}: {status}")
+                return [], 0
+            movies = sorted(result.get('results', []), key=itemgetter('popularity'), reverse=True)
+            total_pages = min(result.get('total_pages') or 1, MAX_PAGES)
+            await cache_io(search_cache, search_cache.set, cache_key, {'results': movies, 'total_pages': total_pages})
+        finally:
+            if claimed:
+                await self.release(search_cache, cache_key)
+        await cache_io(movie_cache, lambda: [movie_cache.set(movie['id'], movie) for movie in movies])
+        suggestions.add_movies(movies)
+        return movies, total_pages
+
+    async def search(self, query, page=1):
+        movies, total_pages = await self.search_page(query, page)
+        return movies
+
+    async def prefetch_pages(self, query, page, total_pages):
+        """Warm the cache with the next few search pages, so moving to them
+        doesn't wait on the search. Only the search pages, their providers
+        would be 20 more calls a page, and those stream in anyway.
+
+        Prefetching comes after live requests: a page is skipped when the rate
+        limiter is under half full, so it never takes tokens a user is waiting on.
+        """
+        pages = range(page + 1, min(page + PREFETCH_PAGES, total_pages) + 1)
+        keys = [(query.strip().lower(), next_page) for next_page in pages]
+        keys = [key for key in keys if key not in self._prefetching]
+        self._prefetching.update(keys)
+
+        async def _prefetch(key):
+            try:
+                if self.bucket.level() >= 0.5:
+                    await self.search(query, key[1])
+            finally:
+                self._prefetching.discard(key)
+
+        await asyncio.gather(*[_prefetch(key) for key in keys])
+
+    def start_prefetch(self, query, page, total_pages):
+        """Kick off prefetch_pages in the background, without waiting on it."""
+        if query and page < total_pages:
+            asyncio.run_coroutine_threadsafe(self.prefetch_pages(query, page, total_pages), self._ensure_loop())
+
+    async def search_results(self, query, page=1, providers=True):
+        """(movies, total_pages) for a search, with the providers added unless
+        providers is False, and the next pages prefetched. Copies the movies so
+        the providers added here don't end up in the cached search results."""
+        start = time.perf_counter()
+        movies, total_pages = await self.search_page(query, page)
+        movies = [dict(movie) for movie in movies]
+        if providers:
+            movies = await self.add_providers(movies)
+        self.start_prefetch(query, page, total_pages)
+        metrics.add_phase('tmdb', time.perf_counter() - start)
+        return movies, total_pages
+
+    async def resolve_movies(self, movie_ids):
+        """TMDB ids to movies with their providers. Ids TMDB doesn't know about are left out."""
+        start = time.perf_counter()
+        movies = await asyncio.gather(*[self.get_movie(movie_id) for movie_id in movie_ids])
+        movies = await self.add_providers([movie for movie in movies if movie])
+        metrics.add_phase('tmdb', time.perf_counter() - start)
+        return movies
+
+    async def get_movie(self, movie_id):
+        """Movie details by TMDB id, from the cache if it came up in a search."""
+        movie = await cache_io(movie_cache, movie_cache.get, movie_id)
+        if movie is not None:
+            return dict(movie)
+
+        status, movie = await self.get_json(f"/movie/{movie_id}", {'language': 'en-US'})
+        if status != 200:
+            print(f"Failed to get details for movie ID {movie_id}: {status}")
+            return None
+        await cache_io(movie_cache, movie_cache.set, movie_id, movie)
+        return dict(movie)
+
+    async def get_providers(self, movie, fresh=False):
+        """Adds the US flatrate providers to the movie. fresh skips the cache read."""
+        movie_id = movie['id']
+        path = f"/movie/{movie_id}/watch/providers"
+        cached, claimed = None if fresh else await cache_io(provider_cache, provider_cache.get, movie_id), False
+        if cached is None and not fresh:
+            cached, claimed = await self.from_peer(provider_cache, movie_id, path)
+        if cached is not None:
+            movie['flatrate'] = cached['flatrate']
+            return movie
+
+        try:
+            status, result = await self.get_json(path)
+            if status != 200:
+                print(f"Failed to get data for movie ID {movie_id}: {status}")
+                return unknown_providers(movie)
+
+            us = result.get('results', {}).get('US')
+            flatrate = us.get('flatrate') if us else None
+            await cache_io(provider_cache, provider_cache.set, movie_id, {'flatrate': flatrate})
+        finally:
+            if claimed:
+                await self.release(provider_cache, movie_id)
+        movie['flatrate'] = flatrate
+        return movie
+
+    async def get_providers_or_unknown(self, movie, deadline, fresh=False):
+        """A lookup that takes longer than the deadline (retries included), or
+        fails in any other way, gives up and marks the providers as unknown,
+        instead of holding up or failing the page."""
+        try:
+            return await asyncio.wait_for(self.get_providers(movie, fresh), deadline)
+        except asyncio.TimeoutError:
+            print(f"Gave up on providers for movie ID {movie['id']}")
+            return unknown_providers(movie)
+        except Exception as e:
+            print(f"Provider lookup for movie ID {movie['id']} failed: {e!r}")
+            return unknown_providers(movie)
+
+    async def add_providers(self, movies, deadline=None, fresh=False):
+        """Look up the providers for every movie at once"""
+        deadline = deadline or self.timeout * 2
+        tasks = [self.get_providers_or_unknown(movie, deadline, fresh) for movie in movies]
+        return await asyncio.gather(*tasks)
+
+    def iter_providers(self, movies, deadline=None):
+        """Sync generator that yields each movie as soon as its providers come
+        back, fastest first, so the view can stream them out."""
+        deadline = deadline or self.timeout * 2
+        results = queue.Queue()
+        done = object()
+
+        async def _lookup():
+            try:
+                tasks = [self.get_providers_or_unknown(dict(movie), deadline) for movie in movies]
+                for task in asyncio.as_completed(tasks):
+                    results.put(await task)
+            finally:
+                # Whatever happens the generator has to stop waiting
+                results.put(done)
+
+        self._ensure_loop()
+        asyncio.run_coroutine_threadsafe(_lookup(), self._loop)
+        while True:
+            movie = results.get()
+            if movie is done:
+                return
+            yield movie
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            self.run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+        self._session = None
+
+
+client = TMDBClient(
+    limit_per_host=int(os.environ.get('TMDB_MAX_CONNECTIONS', 20)),
+)
@@ -0,0 +1,82 @@
+import bisect
+import re
+import threading
+
+from models import db, Movie
+
+MAX_SUGGESTIONS = 8
+# How many prefix matches to look at before ranking by popularity
+MAX_SCAN = 200
+
+
+def normalize(text):
+    return ' '.join(re.findall(r"\w+", (text or '').lower()))
+
+
+class PrefixIndex:
+    """Sorted array of title keys for as-you-type suggestions. Every title is
+    stored once per word, so "knight" finds "The Dark Knight" too. Lookups are
+    a bisect plus a short scan, adding a title is an insort."""
+
+    def __init__(self):
+        self.keys = []
+        self.movies = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _store(self, movie_id, title, year, popularity):
+        """Save the movie and return its new keys, [] if it was already in. Call with the lock held."""
+        known = movie_id in self.movies
+        self.movies[movie_id] = {'id': movie_id, 'title': title, 'year': (year or '')[:4], 'popularity': popularity or 0}
+        if known:
+            return []
+        words = normalize(title).split()
+        return [(' '.join(words[start:]), movie_id) for start in range(len(words))]
+
+    def add(self, movie_id, title, year=None, popularity=0):
+        """Add or update a movie by TMDB id."""
+        if not movie_id or not title:
+            return
+        with self._lock:
+            for key in self._store(movie_id, title, year, popularity):
+                bisect.insort(self.keys, key)
+
+    def add_movies(self, movies):
+        """Add TMDB search results."""
+        for movie in movies:
+            self.add(movie.get('id'), movie.get('title'), movie.get('release_date'), movie.get('popularity'))
+
+    def load(self):
+        """Fill the index from the movies table, once per worker. Requests that
+        come in while it's loading wait for it instead of loading it again.
+        The keys are sorted once at the end, an insort per title would be
+        quadratic."""
+        with self._load_lock:
+            if self.loaded:
+                return
+            rows = db.session.query(Movie.movie_id, Movie.name, Movie.year, Movie.popularity).all()
+            with self._lock:
+                keys = []
+                for movie_id, name, year, popularity in rows:
+                    if movie_id and name:
+                        keys.extend(self._store(movie_id, name, year, popularity))
+                self.keys = sorted(self.keys + keys)
+            self.loaded = True
+
+    def suggest(self, prefix, limit=MAX_SUGGESTIONS):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            start = bisect.bisect_left(self.keys, (prefix,))
+            found = {}
+            for key, movie_id in self.keys[start:start + MAX_SCAN]:
+                if not key.startswith(prefix):
+                    break
+                found[movie_id] = self.movies[movie_id]
+        ranked = sorted(found.values(), key=lambda movie: movie['popularity'], reverse=True)
+        return [{'id': movie['id'], 'title': movie['title'], 'year': movie['year']} for movie in ranked[:limit]]
+
+
+suggestions = PrefixIndex()
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Movie, Service, Subscription, User, User_Available_Movie, User_Likes_Movie
+from typeahead import suggestions
+
+
+_service_ids = {}
+_service_lock = threading.Lock()
+
+
+def service_ids():
+    """Service name -> id, loaded once per worker. The services table only
+    changes when seed.py is run."""
+    if not _service_ids:
+        with _service_lock:
+            if not _service_ids:
+                _service_ids.update(db.session.query(Service.name, Service.id).all())
+    return _service_ids
+
+
+def insert(model):
+    """INSERT for the current database that supports ON CONFLICT DO NOTHING."""
+    if db.engine.dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
+
+def bump_watchlist_version(*filters):
+    """Mark watchlists as changed, for the users matching filters on User
+    (e.g. User.id == 1). Runs in the caller's transaction."""
+    db.session.execute(update(User).where(*filters).values(watchlist_version=time.time()))
+
+
+def available_rows(*filters):
+    """The (user, movie, service) rows user_available_movies should have: liked
+    movies on a service that's in the user's subscription mask."""
+    return (select(User_Likes_Movie.user_liking_id, User_Likes_Movie.liked_movie_id, Subscription.service_id)
+            .join(Subscription, Subscription.movie_id == User_Likes_Movie.liked_movie_id)
+            .join(Service, Service.id == Subscription.service_id)
+            .join(User, User.id == User_Likes_Movie.user_liking_id)
+            .where(Service.in_mask(User.subscription_mask), *filters))
+
+
+def refresh_availability(user_id=None, movie_ids=None):
+    """Recompute user_available_movies for one user, some movies, one user's
+    likes of some movies, or with neither, for everyone. Runs in the caller's
+    transaction, so call it before committing the change it follows."""
+    likes, stale = [], []
+    if user_id is not None:
+        likes.append(User_Likes_Movie.user_liking_id == user_id)
+        stale.append(User_Available_Movie.user_id == user_id)
+    if movie_ids is not None:
+        likes.append(User_Likes_Movie.liked_movie_id.in_(movie_ids))
+        stale.append(User_Available_Movie.movie_id.in_(movie_ids))
+
+    db.session.execute(delete(User_Available_Movie).where(*stale))
+    db.session.execute(insert(User_Available_Movie).from_select(
+        ['user_id', 'movie_id', 'service_id'], available_rows(*likes)
+    ).on_conflict_do_nothing())
+
+
+def storable(movies):
+    """The TMDB movies that have enough to go in the movies table."""
+    return [movie for movie in movies if movie.get('id') and movie.get('title')]
+
+
+def add_to_watchlist(user_id, movies):
+    """Add TMDB movies (with their 'flatrate' providers) to the user's watchlist.
+
+    Everything goes in one transaction with ON CONFLICT DO NOTHING upserts, so
+    it's a fixed number of round trips however many movies there are, and a
+    double click can't fail on the primary keys. Returns the Movie ids that
+    weren't on the watchlist before.
+    """
+    movies = storable(movies)
+    if not movies:
+        return []
+
+    db.session.execute(insert(Movie).values([{
+        'movie_id': int(movie['id']),
+        'name': movie['title'],
+        'description': movie.get('overview') or '',
+        'image_url': movie.get('poster_path') or '',
+        'year': movie.get('release_date'),
+        'popularity': movie.get('popularity') or 0,
+    } for movie in movies]).on_conflict_do_nothing(index_elements=['movie_id']))
+
+    tmdb_ids = [int(movie['id']) for movie in movies]
+    ids = dict(db.session.query(Movie.movie_id, Movie.id).filter(Movie.movie_id.in_(tmdb_ids)).all())
+
+    added = list(db.session.scalars(insert(User_Likes_Movie).values([
+        {'user_liking_id': user_id, 'liked_movie_id': ids[tmdb_id]} for tmdb_id in set(tmdb_ids)
+    ]).on_conflict_do_nothing().returning(User_Likes_Movie.liked_movie_id)))
+
+    services = service_ids()
+    subscriptions = {
+        (ids[int(movie['id'])], services[provider.get('provider_name')])
+        for movie in movies
+        for provider in movie.get('flatrate') or []
+        if provider.get('provider_name') in services
+    }
+    # RETURNING only gives back the rows that actually went in
+    new_providers = set()
+    if subscriptions:
+        new_providers = set(db.session.scalars(insert(Subscription).values([
+            {'movie_id': movie_id, 'service_id': service_id} for movie_id, service_id in subscriptions
+        ]).on_conflict_do_nothing().returning(Subscription.movie_id)))
+
+    # Only this user's rows change, unless a movie got new providers, which
+    # count for everyone who liked it before too
+    liked = [movie_id for movie_id in set(ids.values()) if movie_id not in new_providers]
+    if liked:
+        refresh_availability(user_id, liked)
+    if new_providers:
+        refresh_availability(movie_ids=list(new_providers))
+        likers = select(User_Likes_Movie.user_liking_id).where(User_Likes_Movie.liked_movie_id.in_(new_providers))
+        bump_watchlist_version(User.id.in_(likers))
+    bump_watchlist_version(User.id == user_id)
+    db.session.commit()
+    suggestions.add_movies(movies)
+    return added